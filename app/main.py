@@ -1,25 +1,44 @@
 from __future__ import annotations
 
+import csv
+import hashlib
 import io
+import logging
 import os
 import re
 import secrets
+import shutil
+import threading
+import time
 import unicodedata
+from collections import deque
 from contextlib import asynccontextmanager
 from datetime import date, datetime, timedelta, timezone
+from functools import lru_cache
 from pathlib import Path
-from typing import Optional
+from typing import BinaryIO, Iterator, NamedTuple, Optional
 from uuid import uuid4
 
+import numpy as np
 import pandas as pd
+import redis
+from anyio import to_thread
 from fastapi import Depends, FastAPI, File, Form, HTTPException, Query, Request, UploadFile, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, Response
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from jose import JWTError, jwt
+from openpyxl import load_workbook
+from openpyxl.cell.cell import TYPE_ERROR
 from passlib.context import CryptContext
-from sqlalchemy import Date, DateTime, Float, ForeignKey, Integer, String, create_engine, delete, extract, func, select, text
-from sqlalchemy.orm import DeclarativeBase, Mapped, Session, mapped_column, relationship, sessionmaker
+from sqlalchemy import BigInteger, Date, DateTime, Float, ForeignKey, Index, Integer, String, bindparam, cast, create_engine, delete, event, extract, false, func, inspect, literal, literal_column, or_, select, text, tuple_, union_all, update
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import DeclarativeBase, Mapped, Session, mapped_column, raiseload, relationship, sessionmaker
+from sqlalchemy.pool import StaticPool
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./app.db")
 UPLOADS_DIR = Path(os.getenv("UPLOADS_DIR", "app/uploads"))
@@ -40,18 +59,176 @@ CSRF_EXEMPT_PATHS = {
 }
 LOGIN_RATE_LIMIT_MAX_ATTEMPTS = int(os.getenv("LOGIN_RATE_LIMIT_MAX_ATTEMPTS", "10"))
 LOGIN_RATE_LIMIT_WINDOW_SECONDS = int(os.getenv("LOGIN_RATE_LIMIT_WINDOW_SECONDS", "300"))
+LOGIN_RATE_LIMIT_PRUNE_INTERVAL = 1000
+REDIS_URL = os.getenv("REDIS_URL", "")
+AUTO_CREATE_SCHEMA = os.getenv("AUTO_CREATE_SCHEMA", "true").lower() == "true"
+THREADPOOL_WORKERS = int(os.getenv("THREADPOOL_WORKERS", "40"))
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "10"))
+PASSWORD_HASH_SCHEME = os.getenv("PASSWORD_HASH_SCHEME", "bcrypt")
+AUTH_CACHE_SECONDS = int(os.getenv("AUTH_CACHE_SECONDS", "30"))
+AUTH_CACHE_MAX_ENTRIES = int(os.getenv("AUTH_CACHE_MAX_ENTRIES", "10000"))
+DASHBOARD_CACHE_SECONDS = int(os.getenv("DASHBOARD_CACHE_SECONDS", "60"))
+DASHBOARD_CACHE_MAX_ENTRIES = int(os.getenv("DASHBOARD_CACHE_MAX_ENTRIES", "2000"))
+BULK_INSERT_CHUNK_SIZE = int(os.getenv("BULK_INSERT_CHUNK_SIZE", "2000"))
+UPLOAD_COPY_CHUNK_SIZE = 1 << 20
+COPY_MIN_ROWS = int(os.getenv("COPY_MIN_ROWS", "500"))
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_QUERY_CACHE_SIZE = int(os.getenv("DB_QUERY_CACHE_SIZE", "1024"))
+GZIP_MINIMUM_SIZE = int(os.getenv("GZIP_MINIMUM_SIZE", "1024"))
+SECURITY_HEADERS = [
+    (b"x-frame-options", b"DENY"),
+    (b"x-content-type-options", b"nosniff"),
+    (b"referrer-policy", b"strict-origin-when-cross-origin"),
+    (b"pragma", b"no-cache"),
+    (b"expires", b"0"),
+    (b"permissions-policy", b"geolocation=(), microphone=(), camera=()"),
+    (
+        b"content-security-policy",
+        b"default-src 'self'; script-src 'self' https://cdn.jsdelivr.net; style-src 'self'; img-src 'self' data:; connect-src 'self'; frame-ancestors 'none';",
+    ),
+]
 CORS_ALLOW_ORIGINS = [
     item.strip()
     for item in os.getenv("CORS_ALLOW_ORIGINS", "http://localhost:8000,http://127.0.0.1:8000").split(",")
     if item.strip()
 ]
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+EXCEL_NA_VALUES = frozenset(
+    {"", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN", "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null"}
+)
+COLUMN_ALIASES = {
+    "mes": ["mes", "month"],
+    "fecha": ["fecha", "date", "fec"],
+    "cuenta": ["cuenta", "account"],
+    "categoria": ["categoria", "category", "linea_de_negocio", "categoria_", "linea_de_negocios"],
+    "subcategoria": ["subcategoria", "sub_category", "subcategory", "subtipo_de_movimiento", "etapa_de_linea_de_negocio"],
+    "codigo_proyecto": ["codigo_de_proyecto", "codigo_proyecto", "project_code", "cod_proyecto"],
+    "proyecto": ["proyecto", "project", "nombre_de_proyecto", "nombre_proyecto", "proyecto_nombre", "obra", "item"],
+    "emisor_receptor": ["emisor_receptor", "emisor___receptor", "emisor_o_receptor", "counterparty"],
+    "descripcion": ["descripcion", "description", "detalle", "concepto"],
+    "tipo_documento": ["tipo_de_documento", "tipo_documento", "document_type"],
+    "numero_documento": ["numero_de_documento", "numero_documento", "document_number", "n_documento"],
+    "tipo": ["tipo", "type", "flujo", "flow_type", "tipo_de_movimiento"],
+    "monto": ["monto", "amount", "valor", "importe"],
+    "entrada_neta": ["entradas_netas", "entrada_neta", "entrada", "entradas_brutas"],
+    "salida_neta": ["salida_neta", "salida", "salidas_netas", "salidas_brutas"],
+    "verificado": ["verificado", "checked", "validado"],
+    "comentarios": ["comentarios", "comentario", "comments", "observaciones"],
+    "saldo": ["saldo", "balance"],
+}
+HEADER_SCAN_ROWS = 40
+HEADER_DATE_TOKENS = frozenset({"fecha"})
+HEADER_TYPE_TOKENS = frozenset({"tipo", "tipo_de_movimiento"})
+HEADER_CATEGORY_TOKENS = frozenset({"categoria", "linea_de_negocio", "categoria_"})
+COLUMN_ALIAS_LOOKUP = {
+    alias: (canonical, rank) for canonical, candidates in COLUMN_ALIASES.items() for rank, alias in enumerate(candidates)
+}
+REQUIRED_UPLOAD_COLUMNS = frozenset({"fecha", "categoria", "tipo"})
+NON_ALNUM_PATTERN = re.compile(r"[^a-z0-9]+")
+AMOUNT_CLEAN_PATTERN = re.compile(r"[^0-9,.-]")
+EXCEL_EPOCH = "1899-12-30"
+EXCEL_MAX_SERIAL = 2958465
+ISO_DATE_PATTERN = re.compile(r"(\d{4}[-/]\d{1,2}[-/]\d{1,2})(?:[ T]\d{1,2}:\d{2}(?::\d{2}(?:\.\d+)?)?)?")
+DAYFIRST_DATE_FORMATS = ("%d/%m/%Y", "%d-%m-%Y")
+USERNAME_PATTERN = re.compile(r"[a-zA-Z0-9_.-]{3,80}")
+UNSAFE_FILENAME_PATTERN = re.compile(r"[^a-zA-Z0-9._-]")
+SEARCH_COLUMNS = (
+    "description",
+    "category",
+    "subcategory",
+    "project",
+    "account",
+    "project_code",
+    "counterparty",
+    "document_number",
+)
+ADDED_COLUMNS = (
+    ("accounting_records", "fingerprint", "BIGINT"),
+    ("vaults", "data_version", "INTEGER NOT NULL DEFAULT 0"),
+)
+OBSOLETE_INDEXES = ("ix_accounting_records_owner_id", "ix_accounting_records_scope_fingerprint")
+FINGERPRINT_UNIQUE_INDEX = "uq_accounting_records_scope_fingerprint"
+FINGERPRINT_SCOPE_COLUMNS = ("owner_id", "company_id", "vault_id", "fingerprint")
+FINGERPRINT_COLUMNS = (
+    "date",
+    "account",
+    "category",
+    "subcategory",
+    "project",
+    "project_code",
+    "description",
+    "flow_type",
+    "amount",
+    "document_number",
+)
+FINGERPRINT_TEXT_COLUMNS = ("account", "category", "subcategory", "project", "project_code", "description", "document_number")
+FINGERPRINT_BACKFILL_BATCH_SIZE = 5000
+FINGERPRINT_DEFAULTS = {
+    "account": "General",
+    "category": "",
+    "subcategory": "General",
+    "project": "Sin proyecto",
+    "project_code": "",
+    "description": "",
+    "flow_type": "",
+    "amount": 0.0,
+    "document_number": "",
+}
+FLOW_TYPE_ALIASES = {"ingreso": "ingreso", "egreso": "egreso", "entrada": "ingreso", "salida": "egreso"}
+
+try:
+    import python_calamine  # noqa: F401
+except ImportError:
+    EXCEL_READER_ENGINE = "openpyxl"
+else:
+    EXCEL_READER_ENGINE = "calamine"
+
+pwd_context = CryptContext(
+    schemes=list(dict.fromkeys([PASSWORD_HASH_SCHEME, "bcrypt"])),
+    deprecated="auto",
+    bcrypt__default_rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+    bcrypt__ident="2b",
+)
+logger = logging.getLogger(__name__)
 security = HTTPBearer(auto_error=False)
-login_attempts_by_ip: dict[str, list[datetime]] = {}
+login_attempts_by_ip: dict[str, deque[float]] = {}
+login_attempts_lock = threading.Lock()
+failed_attempts_since_prune = 0
+redis_client = None
+if REDIS_URL:
+    redis_client = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+token_payload_cache: dict[str, tuple[dict, float]] = {}
+user_cache: dict[int, tuple[AuthUser, float]] = {}
+company_scope_cache: dict[tuple[int, Optional[int]], tuple[CompanyScope, float]] = {}
+dashboard_cache: dict[tuple, tuple[object, float]] = {}
+
+
+def cache_get(cache: dict, key, now: float):
+    entry = cache.pop(key, None)
+    if entry is None:
+        return None
+    value, expires_at = entry
+    if expires_at <= now:
+        return None
+    cache[key] = entry
+    return value
+
+
+def cache_set(cache: dict, key, value, expires_at: float, now: float, max_entries: int = AUTH_CACHE_MAX_ENTRIES) -> None:
+    if len(cache) >= max_entries:
+        for cached_key, (_, item_expires_at) in list(cache.items()):
+            if item_expires_at <= now:
+                cache.pop(cached_key, None)
+        while len(cache) >= max_entries:
+            cache.pop(next(iter(cache)), None)
+    cache[key] = (value, expires_at)
 
 
-def add_cors_headers(response: JSONResponse, request: Request) -> JSONResponse:
+def add_cors_headers(response: ORJSONResponse, request: Request) -> ORJSONResponse:
     origin = request.headers.get("origin")
     if origin and origin in CORS_ALLOW_ORIGINS:
         response.headers["Access-Control-Allow-Origin"] = origin
@@ -79,6 +256,16 @@ class User(Base):
     upload_batches: Mapped[list[UploadBatch]] = relationship(back_populates="owner")
 
 
+class AuthUser(NamedTuple):
+    id: int
+    username: str
+    full_name: str
+
+
+class CompanyScope(NamedTuple):
+    id: int
+
+
 class Company(Base):
     __tablename__ = "companies"
 
@@ -104,6 +291,7 @@ class Vault(Base):
     company_id: Mapped[int] = mapped_column(ForeignKey("companies.id"), index=True)
     name: Mapped[str] = mapped_column(String(140), index=True)
     period_type: Mapped[str] = mapped_column(String(30), default="custom")
+    data_version: Mapped[int] = mapped_column(Integer, default=0)
     created_at: Mapped[datetime] = mapped_column(DateTime, default=lambda: datetime.now(timezone.utc))
 
     owner: Mapped[User] = relationship(back_populates="vaults")
@@ -134,9 +322,15 @@ class UploadBatch(Base):
 
 class AccountingRecord(Base):
     __tablename__ = "accounting_records"
+    __table_args__ = (
+        Index("ix_accounting_records_scope_date", "owner_id", "company_id", "vault_id", "date"),
+        Index("ix_accounting_records_scope_category", "owner_id", "company_id", "vault_id", "category"),
+        Index("ix_accounting_records_scope_flow_date", "owner_id", "company_id", "vault_id", "flow_type", "date"),
+        Index(FINGERPRINT_UNIQUE_INDEX, *FINGERPRINT_SCOPE_COLUMNS, unique=True),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
-    owner_id: Mapped[int] = mapped_column(ForeignKey("users.id"), index=True)
+    owner_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
     company_id: Mapped[Optional[int]] = mapped_column(ForeignKey("companies.id"), index=True, nullable=True)
     vault_id: Mapped[Optional[int]] = mapped_column(ForeignKey("vaults.id"), index=True, nullable=True)
     upload_batch_id: Mapped[Optional[int]] = mapped_column(ForeignKey("upload_batches.id"), index=True, nullable=True)
@@ -157,6 +351,7 @@ class AccountingRecord(Base):
     amount: Mapped[float] = mapped_column(Float)
     balance: Mapped[float] = mapped_column(Float, default=0.0)
     source_filename: Mapped[str] = mapped_column(String(255), default="")
+    fingerprint: Mapped[Optional[int]] = mapped_column(BigInteger, nullable=True)
     created_at: Mapped[datetime] = mapped_column(DateTime, default=lambda: datetime.now(timezone.utc))
 
     owner: Mapped[User] = relationship(back_populates="uploads")
@@ -165,27 +360,124 @@ class AccountingRecord(Base):
     upload_batch: Mapped[Optional[UploadBatch]] = relationship(back_populates="records")
 
 
-engine = create_engine(DATABASE_URL)
+database_url = make_url(DATABASE_URL)
+if database_url.get_backend_name() == "sqlite" and database_url.database in (None, "", ":memory:"):
+    engine = create_engine(
+        DATABASE_URL,
+        poolclass=StaticPool,
+        connect_args={"check_same_thread": False},
+        query_cache_size=DB_QUERY_CACHE_SIZE,
+    )
+else:
+    engine = create_engine(
+        DATABASE_URL,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_pre_ping=True,
+        pool_recycle=DB_POOL_RECYCLE,
+        query_cache_size=DB_QUERY_CACHE_SIZE,
+    )
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
 
+if engine.dialect.name == "sqlite":
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, _) -> None:
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA mmap_size=268435456")
+        cursor.execute("PRAGMA cache_size=-65536")
+        cursor.close()
+
 
 @asynccontextmanager
 async def lifespan(_: FastAPI):
-    Base.metadata.create_all(bind=engine)
-    ensure_schema_evolution()
+    to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_WORKERS
+    if AUTO_CREATE_SCHEMA:
+        ensure_schema_evolution()
     UPLOADS_DIR.mkdir(parents=True, exist_ok=True)
     yield
 
 
-def ensure_schema_evolution() -> None:
-    Base.metadata.create_all(bind=engine)
+def backfill_record_fingerprints() -> None:
+    record_table = AccountingRecord.__table__
+    while True:
+        with engine.begin() as connection:
+            rows = connection.execute(
+                select(record_table.c.id, *(record_table.c[column] for column in FINGERPRINT_COLUMNS))
+                .where(record_table.c.fingerprint.is_(None))
+                .limit(FINGERPRINT_BACKFILL_BATCH_SIZE)
+            ).all()
+            if not rows:
+                return
+            records = fill_fingerprint_defaults(pd.DataFrame(rows, columns=["id", *FINGERPRINT_COLUMNS]))
+            connection.execute(
+                update(record_table)
+                .where(record_table.c.id == bindparam("record_id"))
+                .values(fingerprint=bindparam("record_fingerprint")),
+                [
+                    {"record_id": record_id, "record_fingerprint": fingerprint}
+                    for record_id, fingerprint in zip(records["id"].tolist(), build_record_fingerprints(records).tolist())
+                ],
+            )
 
 
-ensure_schema_evolution()
+def release_duplicate_fingerprints() -> None:
+    record_table = AccountingRecord.__table__
+    scope_columns = [record_table.c[column] for column in FINGERPRINT_SCOPE_COLUMNS]
+    kept_ids = select(func.min(record_table.c.id)).group_by(*scope_columns)
+    with engine.begin() as connection:
+        connection.execute(
+            update(record_table)
+            .where(record_table.c.fingerprint.is_not(None))
+            .where(record_table.c.id.not_in(kept_ids))
+            .values(fingerprint=None)
+        )
 
 
-app = FastAPI(title="Contabilidad Dinámica", lifespan=lifespan)
+def ensure_schema_evolution() -> None:
+    Base.metadata.create_all(bind=engine)
+    inspector = inspect(engine)
+    for table_name, column_name, column_ddl in ADDED_COLUMNS:
+        if column_name not in {column["name"] for column in inspector.get_columns(table_name)}:
+            with engine.begin() as connection:
+                connection.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_ddl}"))
+    if FINGERPRINT_UNIQUE_INDEX not in {index["name"] for index in inspector.get_indexes("accounting_records")}:
+        backfill_record_fingerprints()
+        release_duplicate_fingerprints()
+    for index in AccountingRecord.__table__.indexes:
+        index.create(bind=engine, checkfirst=True)
+    with engine.begin() as connection:
+        for index_name in OBSOLETE_INDEXES:
+            connection.execute(text(f"DROP INDEX IF EXISTS {index_name}"))
+    if engine.dialect.name == "postgresql":
+        search_expression = " || ' | ' || ".join(f"coalesce({column}, '')" for column in SEARCH_COLUMNS)
+        with engine.begin() as connection:
+            connection.execute(
+                text(
+                    "ALTER TABLE accounting_records ADD COLUMN IF NOT EXISTS search_text text "
+                    f"GENERATED ALWAYS AS (lower({search_expression})) STORED"
+                )
+            )
+        try:
+            with engine.begin() as connection:
+                connection.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+                connection.execute(
+                    text(
+                        "CREATE INDEX IF NOT EXISTS ix_accounting_records_search_text "
+                        "ON accounting_records USING gin (search_text gin_trgm_ops)"
+                    )
+                )
+        except SQLAlchemyError as exc:
+            logger.warning("No se pudo crear el índice pg_trgm; la búsqueda usará un recorrido secuencial: %s", exc)
 
+
+app = FastAPI(title="Contabilidad Dinámica", lifespan=lifespan, default_response_class=ORJSONResponse)
+
+app.add_middleware(GZipMiddleware, minimum_size=GZIP_MINIMUM_SIZE)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=CORS_ALLOW_ORIGINS,
@@ -206,19 +498,13 @@ async def set_security_headers(request: Request, call_next):
             csrf_valid = bool(csrf_cookie and csrf_header and secrets.compare_digest(csrf_cookie, csrf_header))
             if not csrf_valid and not origin_allowed:
                 return add_cors_headers(
-                    JSONResponse(status_code=403, content={"detail": "CSRF/Origin inválido"}),
+                    ORJSONResponse(status_code=403, content={"detail": "CSRF/Origin inválido"}),
                     request,
                 )
 
     response = await call_next(request)
-    response.headers["X-Frame-Options"] = "DENY"
-    response.headers["X-Content-Type-Options"] = "nosniff"
-    response.headers["Referrer-Policy"] = "strict-origin-when-cross-origin"
-    response.headers["Cache-Control"] = "no-store"
-    response.headers["Pragma"] = "no-cache"
-    response.headers["Expires"] = "0"
-    response.headers["Permissions-Policy"] = "geolocation=(), microphone=(), camera=()"
-    response.headers["Content-Security-Policy"] = "default-src 'self'; script-src 'self' https://cdn.jsdelivr.net; style-src 'self'; img-src 'self' data:; connect-src 'self'; frame-ancestors 'none';"
+    response.raw_headers.extend(SECURITY_HEADERS)
+    response.headers.setdefault("Cache-Control", "no-store")
     return response
 
 
@@ -234,94 +520,176 @@ def hash_password(password: str) -> str:
     return pwd_context.hash(password)
 
 
-def verify_password(password: str, password_hash: str) -> bool:
-    return pwd_context.verify(password, password_hash)
+def verify_and_update_password(password: str, password_hash: str) -> tuple[bool, Optional[str]]:
+    password_ok, upgraded_hash = pwd_context.verify_and_update(password, password_hash)
+    if password_ok and upgraded_hash is None and password_hash.startswith("$2a$"):
+        upgraded_hash = pwd_context.hash(password)
+    return password_ok, upgraded_hash
 
 
-def create_token(subject: str, token_type: str, expires_delta: timedelta) -> str:
+def create_token(subject: str, user_id: int, token_type: str, expires_delta: timedelta) -> str:
     expire = datetime.now(timezone.utc) + expires_delta
-    payload = {"sub": subject, "type": token_type, "exp": expire}
+    payload = {"sub": subject, "uid": user_id, "type": token_type, "exp": expire}
     return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
 
-def decode_token(token: str, expected_type: str) -> str:
-    try:
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-    except JWTError as exc:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token inválido") from exc
+def decode_token(token: str, expected_type: str) -> dict:
+    now = time.time()
+    cache_key = hashlib.sha256(token.encode("utf-8")).hexdigest()
+    payload = cache_get(token_payload_cache, cache_key, now)
+    if payload is None:
+        try:
+            payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+        except JWTError as exc:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token inválido") from exc
+        expires_at = min(float(payload.get("exp", now)), now + AUTH_CACHE_SECONDS)
+        cache_set(token_payload_cache, cache_key, payload, expires_at, now)
     if payload.get("type") != expected_type:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Tipo de token inválido")
-    subject = payload.get("sub")
-    if not subject:
+    if not payload.get("sub"):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token sin subject")
-    return subject
+    if "uid" in payload and not isinstance(payload["uid"], int):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token sin usuario")
+    return payload
+
+
+def resolve_token_user(db: Session, payload: dict) -> AuthUser:
+    now = time.time()
+    user_id = payload.get("uid")
+    if user_id is not None:
+        user = cache_get(user_cache, user_id, now)
+        if user is not None:
+            return user
+        row = db.execute(select(User.id, User.username, User.full_name).where(User.id == user_id)).first()
+    else:
+        row = db.execute(select(User.id, User.username, User.full_name).where(User.username == payload["sub"])).first()
+    if row is None:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Usuario no encontrado")
+    user = AuthUser(*row)
+    cache_set(user_cache, user.id, user, now + AUTH_CACHE_SECONDS, now)
+    return user
 
 
+@lru_cache(maxsize=4096)
 def normalize_column_name(value: str) -> str:
     normalized = unicodedata.normalize("NFKD", value).encode("ascii", "ignore").decode("ascii")
     normalized = normalized.strip().lower()
-    normalized = re.sub(r"[^a-z0-9]+", "_", normalized)
+    normalized = NON_ALNUM_PATTERN.sub("_", normalized)
     return normalized.strip("_")
 
 
-def parse_amount(value) -> float:
-    if pd.isna(value):
-        raise ValueError("Monto vacío")
-    if isinstance(value, (int, float)):
-        return float(value)
-    text = str(value).strip().replace(" ", "")
-    text = re.sub(r"[^0-9,.-]", "", text)
-    if not text:
-        raise ValueError("Monto inválido")
-    if "," in text and "." in text:
-        if text.rfind(",") > text.rfind("."):
-            text = text.replace(".", "").replace(",", ".")
-        else:
-            text = text.replace(",", "")
-    elif "," in text:
-        text = text.replace(".", "").replace(",", ".")
-    return float(text)
-
-
-def parse_excel_date(value) -> date:
-    if pd.isna(value):
-        raise ValueError("Fecha vacía")
-    if isinstance(value, datetime):
-        return value.date()
-    if isinstance(value, date):
-        return value
-
-    text_value = str(value).strip()
-    if not text_value:
-        raise ValueError("Fecha inválida")
+def parse_amount_series(series: pd.Series) -> pd.Series:
+    is_text = series.map(type) == str
+    amounts = pd.to_numeric(series.where(~is_text), errors="coerce").astype(float)
+    if is_text.any():
+        text_values = series[is_text].str.replace(AMOUNT_CLEAN_PATTERN, "", regex=True)
+        last_comma = text_values.str.rfind(",")
+        last_dot = text_values.str.rfind(".")
+        decimal_comma = (last_comma >= 0) & (last_comma > last_dot)
+        thousands_comma = (last_comma >= 0) & (last_comma < last_dot)
+        text_values = text_values.mask(
+            decimal_comma,
+            text_values.str.replace(".", "", regex=False).str.replace(",", ".", regex=False),
+        )
+        text_values = text_values.mask(thousands_comma, text_values.str.replace(",", "", regex=False))
+        amounts.loc[is_text] = pd.to_numeric(text_values, errors="coerce")
+    return amounts
+
+
+def parse_date_series(series: pd.Series) -> pd.Series:
+    is_datetime = series.map(lambda value: isinstance(value, (datetime, date)))
+    is_text = series.map(type) == str
+    parsed = pd.Series(pd.NaT, index=series.index, dtype="datetime64[ns]")
+
+    if is_datetime.any():
+        parsed.loc[is_datetime] = pd.to_datetime(series[is_datetime], errors="coerce")
+    numeric = ~is_datetime & ~is_text & series.notna()
+    if numeric.any():
+        serials = pd.to_numeric(series[numeric], errors="coerce")
+        serials = serials.where(serials.between(1, EXCEL_MAX_SERIAL))
+        parsed.loc[numeric] = pd.to_datetime(serials, unit="D", origin=EXCEL_EPOCH, errors="coerce")
+    if is_text.any():
+        text_values = series[is_text].str.strip()
+        iso_like = text_values.str.fullmatch(ISO_DATE_PATTERN)
+        parsed.loc[iso_like[iso_like].index] = pd.to_datetime(
+            text_values[iso_like].str.extract(ISO_DATE_PATTERN, expand=False).str.replace("/", "-", regex=False),
+            format="%Y-%m-%d",
+            errors="coerce",
+        )
+        other = text_values[~iso_like & (text_values != "")]
+        if not other.empty:
+            parsed_other = pd.Series(pd.NaT, index=other.index, dtype="datetime64[ns]")
+            missing = parsed_other.isna()
+            for date_format in DAYFIRST_DATE_FORMATS:
+                parsed_other.loc[missing] = pd.to_datetime(other[missing], format=date_format, errors="coerce")
+                missing = parsed_other.isna()
+                if not missing.any():
+                    break
+            if missing.any():
+                parsed_other.loc[missing] = pd.to_datetime(other[missing], format="mixed", dayfirst=True, errors="coerce")
+                missing = parsed_other.isna()
+            if missing.any():
+                parsed_other.loc[missing] = pd.to_datetime(other[missing], format="mixed", dayfirst=False, errors="coerce")
+            parsed.loc[other.index] = parsed_other
+
+    return parsed
+
+
+def convert_excel_cell(cell):
+    value = cell.value
+    if value is None or cell.data_type == TYPE_ERROR:
+        return np.nan
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, str) and value in EXCEL_NA_VALUES:
+        return np.nan
+    return value
+
+
+def iter_workbook_sheets(source: Path | BinaryIO, suffix: str) -> Iterator[pd.DataFrame]:
+    if EXCEL_READER_ENGINE == "calamine":
+        with pd.ExcelFile(source, engine="calamine") as excel_file:
+            for sheet_name in excel_file.sheet_names:
+                yield excel_file.parse(sheet_name, header=None, dtype=object, na_values=list(EXCEL_NA_VALUES))
+        return
+    if suffix.lower() != ".xlsx":
+        with pd.ExcelFile(source) as excel_file:
+            for sheet_name in excel_file.sheet_names:
+                yield excel_file.parse(sheet_name, header=None)
+        return
+
+    workbook = load_workbook(source, read_only=True, data_only=True, keep_links=False)
+    try:
+        for worksheet in workbook.worksheets:
+            yield pd.DataFrame(
+                [[convert_excel_cell(cell) for cell in row] for row in worksheet.iter_rows()],
+                dtype=object,
+            )
+    finally:
+        workbook.close()
 
-    iso_like = re.match(r"^\d{4}[-/]\d{1,2}[-/]\d{1,2}$", text_value)
-    if iso_like:
-        return datetime.fromisoformat(text_value.replace("/", "-")).date()
 
-    parsed = pd.to_datetime(value, dayfirst=True, errors="coerce")
-    if pd.isna(parsed):
-        parsed = pd.to_datetime(value, dayfirst=False, errors="raise")
-    return parsed.date()
+def match_upload_columns(columns) -> dict[str, str]:
+    matches: dict[str, tuple[int, str]] = {}
+    for column in columns:
+        target = COLUMN_ALIAS_LOOKUP.get(normalize_column_name(str(column)))
+        if target is None:
+            continue
+        canonical, rank = target
+        if canonical not in matches or rank <= matches[canonical][0]:
+            matches[canonical] = (rank, column)
+    return {canonical: column for canonical, (_, column) in matches.items()}
 
 
 def detect_header_row(raw_dataframe: pd.DataFrame) -> Optional[int]:
-    max_rows = min(len(raw_dataframe), 40)
-    for row_index in range(max_rows):
-        row_values = {
-            normalize_column_name(str(value))
-            for value in raw_dataframe.iloc[row_index].tolist()
-            if pd.notna(value) and str(value).strip()
-        }
-        if "fecha" in row_values and (
-            "tipo" in row_values or "tipo_de_movimiento" in row_values
-        ) and (
-            "categoria" in row_values
-            or "linea_de_negocio" in row_values
-            or "categoria_" in row_values
-        ):
-            return row_index
-    return None
+    normalized = raw_dataframe.head(HEADER_SCAN_ROWS).astype(str).map(normalize_column_name)
+    is_header = (
+        normalized.isin(HEADER_DATE_TOKENS).any(axis=1)
+        & normalized.isin(HEADER_TYPE_TOKENS).any(axis=1)
+        & normalized.isin(HEADER_CATEGORY_TOKENS).any(axis=1)
+    )
+    header_rows = np.flatnonzero(is_header.to_numpy())
+    return int(header_rows[0]) if len(header_rows) else None
 
 
 def extract_sheet_as_table(raw_dataframe: pd.DataFrame) -> Optional[pd.DataFrame]:
@@ -337,8 +705,67 @@ def extract_sheet_as_table(raw_dataframe: pd.DataFrame) -> Optional[pd.DataFrame
     return table
 
 
-def apply_record_filters(
-    query,
+def normalize_text_series(series: pd.Series, fallback="") -> pd.Series:
+    text_values = series.where(series.notna(), "").astype(str).str.strip()
+    return text_values.mask((text_values == "") | (text_values.str.lower() == "nan"), fallback)
+
+
+def prepare_sheet_records(dataframe: pd.DataFrame, column_map: dict[str, str]) -> pd.DataFrame:
+    dataframe = dataframe.loc[:, ~dataframe.columns.duplicated()]
+
+    flow_type = dataframe[column_map["tipo"]].astype(str).str.strip().str.lower().map(FLOW_TYPE_ALIASES)
+    if "monto" in column_map:
+        amount = parse_amount_series(dataframe[column_map["monto"]])
+    else:
+        amount = parse_amount_series(dataframe[column_map["entrada_neta"]]).where(
+            flow_type == "ingreso",
+            parse_amount_series(dataframe[column_map["salida_neta"]]),
+        )
+    parsed_date = parse_date_series(dataframe[column_map["fecha"]])
+
+    valid = flow_type.notna() & amount.notna() & parsed_date.notna()
+    dataframe = dataframe.loc[valid]
+    parsed_date = parsed_date.loc[valid]
+    record_date = parsed_date.dt.date
+
+    def text_column(canonical: str, fallback) -> pd.Series:
+        column = column_map.get(canonical)
+        if column is None:
+            return pd.Series(fallback, index=dataframe.index, dtype=object)
+        return normalize_text_series(dataframe[column], fallback)
+
+    category = dataframe[column_map["categoria"]].astype(str).str.strip()
+    subcategory = text_column("subcategoria", "General")
+    description = text_column("descripcion", "")
+    description = description.mask(description == "", category + " - " + subcategory)
+    balance_column = column_map.get("saldo")
+    balance = parse_amount_series(dataframe[balance_column]) if balance_column else 0.0
+
+    records = pd.DataFrame(
+        {
+            "date": record_date,
+            "month": text_column("mes", parsed_date.dt.strftime("%Y-%m")),
+            "account": text_column("cuenta", "General"),
+            "category": category,
+            "subcategory": subcategory,
+            "project": text_column("proyecto", "Sin proyecto"),
+            "project_code": text_column("codigo_proyecto", ""),
+            "counterparty": text_column("emisor_receptor", ""),
+            "description": description,
+            "document_type": text_column("tipo_documento", ""),
+            "document_number": text_column("numero_documento", ""),
+            "flow_type": flow_type.loc[valid],
+            "verified": text_column("verificado", ""),
+            "comments": text_column("comentarios", ""),
+            "amount": amount.loc[valid],
+            "balance": balance,
+        },
+        index=dataframe.index,
+    )
+    return records
+
+
+def build_record_filter_clauses(
     category: Optional[str],
     subcategory: Optional[str],
     project: Optional[str],
@@ -350,87 +777,131 @@ def apply_record_filters(
     date_from: Optional[str],
     date_to: Optional[str],
     search: Optional[str],
-):
+) -> list:
+    clauses = []
     if category:
-        query = query.where(AccountingRecord.category == category)
+        clauses.append(AccountingRecord.category == category)
     if subcategory:
-        query = query.where(AccountingRecord.subcategory == subcategory)
+        clauses.append(AccountingRecord.subcategory == subcategory)
     if project:
-        query = query.where(AccountingRecord.project == project)
+        clauses.append(AccountingRecord.project == project)
     if account:
-        query = query.where(AccountingRecord.account == account)
+        clauses.append(AccountingRecord.account == account)
     if project_code:
-        query = query.where(AccountingRecord.project_code == project_code)
-    if year:
-        year_value = int(year)
-        query = query.where(extract("year", AccountingRecord.date) == year_value)
-    if month_number:
-        month_value = int(month_number)
-        query = query.where(extract("month", AccountingRecord.date) == month_value)
+        clauses.append(AccountingRecord.project_code == project_code)
+    month_value = int(month_number) if month_number else None
+    year_value = int(year) if year else None
+    if (month_value is not None and not 1 <= month_value <= 12) or (year_value is not None and not 1 <= year_value < 9999):
+        return [false()]
+    if year_value is not None and month_value is not None:
+        period_start = date(year_value, month_value, 1)
+        period_end = date(year_value + 1, 1, 1) if month_value == 12 else date(year_value, month_value + 1, 1)
+        clauses.extend((AccountingRecord.date >= period_start, AccountingRecord.date < period_end))
+    elif year_value is not None:
+        clauses.extend((AccountingRecord.date >= date(year_value, 1, 1), AccountingRecord.date < date(year_value + 1, 1, 1)))
+    elif month_value is not None:
+        clauses.append(extract("month", AccountingRecord.date) == month_value)
     if flow_type:
-        query = query.where(AccountingRecord.flow_type == flow_type)
+        clauses.append(AccountingRecord.flow_type == flow_type)
     if date_from:
-        query = query.where(AccountingRecord.date >= datetime.fromisoformat(date_from).date())
+        clauses.append(AccountingRecord.date >= datetime.fromisoformat(date_from).date())
     if date_to:
-        query = query.where(AccountingRecord.date <= datetime.fromisoformat(date_to).date())
+        clauses.append(AccountingRecord.date <= datetime.fromisoformat(date_to).date())
     if search:
         search_term = f"%{search.strip()}%"
-        query = query.where(
-            AccountingRecord.description.ilike(search_term)
-            | AccountingRecord.category.ilike(search_term)
-            | AccountingRecord.subcategory.ilike(search_term)
-            | AccountingRecord.project.ilike(search_term)
-            | AccountingRecord.account.ilike(search_term)
-            | AccountingRecord.project_code.ilike(search_term)
-            | AccountingRecord.counterparty.ilike(search_term)
-            | AccountingRecord.document_number.ilike(search_term)
-        )
-    return query
+        if engine.dialect.name == "postgresql":
+            clauses.append(literal_column("accounting_records.search_text").like(func.lower(search_term)))
+        else:
+            clauses.append(or_(*(getattr(AccountingRecord, column).ilike(search_term) for column in SEARCH_COLUMNS)))
+    return clauses
+
+
+def load_record_facets(db: Session, user: AuthUser, company: CompanyScope, vault: Vault, category: Optional[str]) -> dict[str, list[str]]:
+    scope_filters = (
+        AccountingRecord.owner_id == user.id,
+        AccountingRecord.company_id == company.id,
+        AccountingRecord.vault_id == vault.id,
+    )
+    year_column = cast(cast(extract("year", AccountingRecord.date), Integer), String)
+    facet_columns = {
+        "categories": (AccountingRecord.category, False),
+        "subcategories": (AccountingRecord.subcategory, True),
+        "projects": (AccountingRecord.project, True),
+        "accounts": (AccountingRecord.account, False),
+        "project_codes": (AccountingRecord.project_code, False),
+        "years": (year_column, False),
+    }
+    facet_queries = []
+    for facet, (column, filter_by_category) in facet_columns.items():
+        facet_query = select(literal(facet).label("facet"), cast(column, String).label("value")).where(*scope_filters)
+        if filter_by_category and category:
+            facet_query = facet_query.where(AccountingRecord.category == category)
+        facet_queries.append(facet_query.group_by(column))
+    facet_union = union_all(*facet_queries).subquery()
+
+    facets: dict[str, list[str]] = {facet: [] for facet in facet_columns}
+    for facet, value in db.execute(select(facet_union.c.facet, facet_union.c.value).order_by(facet_union.c.facet, facet_union.c.value)):
+        if value:
+            facets[facet].append(value)
+    facets["years"].sort(key=int, reverse=True)
+    return facets
+
+
+def cached_record_facets(db: Session, user: AuthUser, company: CompanyScope, vault: Vault, category: Optional[str]) -> dict[str, list[str]]:
+    now = time.time()
+    cache_key = ("facets", vault.id, vault.data_version, category)
+    facets = cache_get(dashboard_cache, cache_key, now)
+    if facets is None:
+        facets = load_record_facets(db, user, company, vault, category)
+        cache_set(dashboard_cache, cache_key, facets, now + DASHBOARD_CACHE_SECONDS, now, DASHBOARD_CACHE_MAX_ENTRIES)
+    return facets
 
 
 def get_current_user(
     request: Request,
     db: Session = Depends(get_db),
     bearer: Optional[HTTPAuthorizationCredentials] = Depends(security),
-) -> User:
+) -> AuthUser:
     raw_token = request.cookies.get("access_token")
     if not raw_token and bearer:
         raw_token = bearer.credentials
     if not raw_token:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="No autenticado")
-    username = decode_token(raw_token, "access")
-    user = db.scalar(select(User).where(User.username == username))
-    if not user:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Usuario no encontrado")
-    return user
+    return resolve_token_user(db, decode_token(raw_token, "access"))
 
 
 def resolve_company(
-    user: User,
+    user: AuthUser,
     db: Session,
     company_id: Optional[int],
-) -> Company:
+) -> CompanyScope:
+    now = time.time()
+    cache_key = (user.id, company_id)
+    cached_company = cache_get(company_scope_cache, cache_key, now)
+    if cached_company is not None:
+        return cached_company
+
     if company_id is not None:
-        company = db.scalar(select(Company).where(Company.id == company_id, Company.owner_id == user.id))
-        if not company:
+        resolved_id = db.scalar(select(Company.id).where(Company.id == company_id, Company.owner_id == user.id))
+        if resolved_id is None:
             raise HTTPException(status_code=404, detail="Compañía no encontrada")
-        return company
-
-    company = db.scalar(select(Company).where(Company.owner_id == user.id).order_by(Company.id.asc()))
-    if company:
-        return company
+    else:
+        resolved_id = db.scalar(select(Company.id).where(Company.owner_id == user.id).order_by(Company.id.asc()))
+        if resolved_id is None:
+            company = Company(owner_id=user.id, name="Empresa principal")
+            db.add(company)
+            db.commit()
+            resolved_id = company.id
 
-    company = Company(owner_id=user.id, name="Empresa principal")
-    db.add(company)
-    db.commit()
-    db.refresh(company)
-    return company
+    company_scope = CompanyScope(resolved_id)
+    cache_set(company_scope_cache, cache_key, company_scope, now + AUTH_CACHE_SECONDS, now)
+    return company_scope
 
 
 def resolve_vault(
-    user: User,
+    user: AuthUser,
     db: Session,
-    company: Company,
+    company: CompanyScope,
     vault_id: Optional[int],
 ) -> Vault:
     if vault_id is not None:
@@ -460,46 +931,74 @@ def resolve_vault(
     return vault
 
 
-def normalize_text_value(value: object, fallback: str = "") -> str:
-    if value is None or pd.isna(value):
-        return fallback
-    text = str(value).strip()
-    if not text or text.lower() == "nan":
-        return fallback
-    return text
-
-
-def build_record_fingerprint(
-    owner_id: int,
-    parsed_date,
-    account: str,
-    category: str,
-    subcategory: str,
-    project: str,
-    project_code: str,
-    description: str,
-    flow_type: str,
-    amount: float,
-    document_number: str,
-) -> tuple:
-    return (
-        owner_id,
-        parsed_date.isoformat(),
-        account.lower(),
-        category.lower(),
-        subcategory.lower(),
-        project.lower(),
-        project_code.lower(),
-        description.lower(),
-        flow_type,
-        round(amount, 2),
-        document_number.lower(),
+def bump_vault_data_version(db: Session, vault: Vault) -> None:
+    db.execute(update(Vault).where(Vault.id == vault.id).values(data_version=Vault.data_version + 1))
+
+
+def build_record_fingerprints(records: pd.DataFrame) -> np.ndarray:
+    keys = pd.DataFrame(
+        {
+            "date": records["date"].astype(str),
+            **{column: records[column].str.lower() for column in FINGERPRINT_TEXT_COLUMNS},
+            "flow_type": records["flow_type"],
+            "amount": records["amount"].astype(float).round(2),
+        }
     )
+    return pd.util.hash_pandas_object(keys, index=False).to_numpy().view(np.int64)
+
+
+def fill_fingerprint_defaults(records: pd.DataFrame) -> pd.DataFrame:
+    for column, fallback in FINGERPRINT_DEFAULTS.items():
+        records[column] = records[column].fillna(fallback).replace("", fallback)
+    return records
+
+
+def insert_accounting_records(db: Session, rows: list[dict]) -> int:
+    dialect_name = db.get_bind().dialect.name
+    if dialect_name not in ("postgresql", "sqlite"):
+        raise RuntimeError(f"Motor de base de datos no soportado para cargas: {dialect_name}")
+    if dialect_name == "sqlite" or len(rows) < COPY_MIN_ROWS:
+        dialect_insert = sqlite_insert if dialect_name == "sqlite" else postgresql_insert
+        statement = (
+            dialect_insert(AccountingRecord)
+            .on_conflict_do_nothing(index_elements=list(FINGERPRINT_SCOPE_COLUMNS))
+            .returning(AccountingRecord.id)
+        )
+        inserted = 0
+        for start in range(0, len(rows), BULK_INSERT_CHUNK_SIZE):
+            inserted += len(db.execute(statement, rows[start : start + BULK_INSERT_CHUNK_SIZE]).all())
+        return inserted
+
+    columns = [*rows[0].keys(), "created_at"]
+    created_at = datetime.now(timezone.utc)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, quoting=csv.QUOTE_NONNUMERIC)
+    for row in rows:
+        writer.writerow([*row.values(), created_at])
+    buffer.seek(0)
+    column_list = ", ".join(columns)
+    cursor = db.connection().connection.cursor()
+    try:
+        cursor.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS accounting_records_incoming ON COMMIT DROP AS "
+            f"SELECT {column_list} FROM {AccountingRecord.__tablename__} WITH NO DATA"
+        )
+        cursor.copy_expert(f"COPY accounting_records_incoming ({column_list}) FROM STDIN WITH (FORMAT csv)", buffer)
+        cursor.execute(
+            f"INSERT INTO {AccountingRecord.__tablename__} ({column_list}) "
+            f"SELECT {column_list} FROM accounting_records_incoming "
+            f"ON CONFLICT ({', '.join(FINGERPRINT_SCOPE_COLUMNS)}) DO NOTHING"
+        )
+        inserted = cursor.rowcount
+        cursor.execute("TRUNCATE accounting_records_incoming")
+    finally:
+        cursor.close()
+    return inserted
 
 
-def set_auth_cookies(response: JSONResponse, username: str) -> None:
-    access = create_token(username, "access", timedelta(minutes=ACCESS_TOKEN_MINUTES))
-    refresh = create_token(username, "refresh", timedelta(days=REFRESH_TOKEN_DAYS))
+def set_auth_cookies(response: ORJSONResponse, username: str, user_id: int) -> None:
+    access = create_token(username, user_id, "access", timedelta(minutes=ACCESS_TOKEN_MINUTES))
+    refresh = create_token(username, user_id, "refresh", timedelta(days=REFRESH_TOKEN_DAYS))
     csrf_token = secrets.token_urlsafe(32)
     response.set_cookie(
         "access_token",
@@ -530,12 +1029,17 @@ def set_auth_cookies(response: JSONResponse, username: str) -> None:
     )
 
 
-def clear_auth_cookies(response: JSONResponse) -> None:
+def clear_auth_cookies(response: ORJSONResponse) -> None:
     response.delete_cookie("access_token")
     response.delete_cookie("refresh_token")
     response.delete_cookie(CSRF_COOKIE_NAME)
 
 
+def etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match", "")
+    return etag in {item.strip() for item in if_none_match.split(",")} or if_none_match.strip() == "*"
+
+
 def get_client_ip(request: Request) -> str:
     forwarded_for = request.headers.get("x-forwarded-for", "")
     if forwarded_for:
@@ -543,21 +1047,58 @@ def get_client_ip(request: Request) -> str:
     return request.client.host if request.client else "unknown"
 
 
+def login_attempts_key(ip_address: str) -> str:
+    return f"rl:login:{ip_address}"
+
+
 def is_rate_limited(ip_address: str, now: datetime) -> bool:
-    window_start = now - timedelta(seconds=LOGIN_RATE_LIMIT_WINDOW_SECONDS)
-    attempts = [timestamp for timestamp in login_attempts_by_ip.get(ip_address, []) if timestamp >= window_start]
-    login_attempts_by_ip[ip_address] = attempts
-    return len(attempts) >= LOGIN_RATE_LIMIT_MAX_ATTEMPTS
+    if redis_client is not None:
+        try:
+            return int(redis_client.get(login_attempts_key(ip_address)) or 0) >= LOGIN_RATE_LIMIT_MAX_ATTEMPTS
+        except redis.RedisError as exc:
+            logger.warning("Redis no disponible para el límite de login, se usa memoria local: %s", exc)
+    window_start = now.timestamp() - LOGIN_RATE_LIMIT_WINDOW_SECONDS
+    with login_attempts_lock:
+        attempts = login_attempts_by_ip.get(ip_address)
+        if not attempts:
+            return False
+        while attempts and attempts[0] < window_start:
+            attempts.popleft()
+        return len(attempts) >= LOGIN_RATE_LIMIT_MAX_ATTEMPTS
 
 
 def register_failed_attempt(ip_address: str, now: datetime) -> None:
-    attempts = login_attempts_by_ip.get(ip_address, [])
-    attempts.append(now)
-    login_attempts_by_ip[ip_address] = attempts
+    global failed_attempts_since_prune
+    if redis_client is not None:
+        key = login_attempts_key(ip_address)
+        try:
+            pipeline = redis_client.pipeline()
+            pipeline.set(key, 0, ex=LOGIN_RATE_LIMIT_WINDOW_SECONDS, nx=True)
+            pipeline.incr(key)
+            pipeline.execute()
+            return
+        except redis.RedisError as exc:
+            logger.warning("Redis no disponible para el límite de login, se usa memoria local: %s", exc)
+    timestamp = now.timestamp()
+    with login_attempts_lock:
+        attempts = login_attempts_by_ip.setdefault(ip_address, deque(maxlen=LOGIN_RATE_LIMIT_MAX_ATTEMPTS))
+        attempts.append(timestamp)
+        failed_attempts_since_prune += 1
+        if failed_attempts_since_prune >= LOGIN_RATE_LIMIT_PRUNE_INTERVAL:
+            failed_attempts_since_prune = 0
+            stale_before = timestamp - 2 * LOGIN_RATE_LIMIT_WINDOW_SECONDS
+            for stale_ip in [ip for ip, ip_attempts in login_attempts_by_ip.items() if not ip_attempts or ip_attempts[-1] < stale_before]:
+                del login_attempts_by_ip[stale_ip]
 
 
 def clear_failed_attempts(ip_address: str) -> None:
-    login_attempts_by_ip.pop(ip_address, None)
+    if redis_client is not None:
+        try:
+            redis_client.delete(login_attempts_key(ip_address))
+        except redis.RedisError as exc:
+            logger.warning("Redis no disponible para el límite de login, se usa memoria local: %s", exc)
+    with login_attempts_lock:
+        login_attempts_by_ip.pop(ip_address, None)
 
 
 @app.get("/")
@@ -576,7 +1117,7 @@ def register(
         raise HTTPException(status_code=400, detail="La contraseña debe tener al menos 10 caracteres")
     if len(password.encode("utf-8")) > 72:
         raise HTTPException(status_code=400, detail="La contraseña no debe superar 72 bytes")
-    if not re.fullmatch(r"[a-zA-Z0-9_.-]{3,80}", username):
+    if not USERNAME_PATTERN.fullmatch(username):
         raise HTTPException(status_code=400, detail="Usuario inválido: usa solo letras, números, guion, punto o guion bajo")
     exists = db.scalar(select(User).where(User.username == username.lower()))
     if exists:
@@ -599,41 +1140,52 @@ def login(request: Request, username: str = Form(...), password: str = Form(...)
         register_failed_attempt(ip_address, now)
         raise HTTPException(status_code=401, detail="Credenciales inválidas")
     user = db.scalar(select(User).where(User.username == username.lower()))
-    if not user or not verify_password(password, user.password_hash):
+    if not user:
+        register_failed_attempt(ip_address, now)
+        raise HTTPException(status_code=401, detail="Credenciales inválidas")
+    password_ok, upgraded_hash = verify_and_update_password(password, user.password_hash)
+    if not password_ok:
         register_failed_attempt(ip_address, now)
         raise HTTPException(status_code=401, detail="Credenciales inválidas")
-    response = JSONResponse({"message": "Login exitoso", "full_name": user.full_name})
+    if upgraded_hash:
+        user.password_hash = upgraded_hash
+        db.commit()
+    response = ORJSONResponse({"message": "Login exitoso", "full_name": user.full_name})
     clear_failed_attempts(ip_address)
-    set_auth_cookies(response, user.username)
+    set_auth_cookies(response, user.username, user.id)
     return response
 
 
 @app.post("/api/auth/refresh")
-def refresh(request: Request):
+def refresh(request: Request, db: Session = Depends(get_db)):
     token = request.cookies.get("refresh_token")
     if not token:
         raise HTTPException(status_code=401, detail="Refresh token no encontrado")
-    username = decode_token(token, "refresh")
-    response = JSONResponse({"message": "Token actualizado"})
-    set_auth_cookies(response, username)
+    user = resolve_token_user(db, decode_token(token, "refresh"))
+    response = ORJSONResponse({"message": "Token actualizado"})
+    set_auth_cookies(response, user.username, user.id)
     return response
 
 
 @app.post("/api/auth/logout")
 def logout():
-    response = JSONResponse({"message": "Logout exitoso"})
+    response = ORJSONResponse({"message": "Logout exitoso"})
     clear_auth_cookies(response)
     return response
 
 
 @app.get("/api/me")
-def me(user: User = Depends(get_current_user)):
-    return {"username": user.username, "full_name": user.full_name}
+def me(request: Request, user: AuthUser = Depends(get_current_user)):
+    etag = '"' + hashlib.sha256(f"{user.id}:{user.username}:{user.full_name}".encode("utf-8")).hexdigest()[:32] + '"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return ORJSONResponse({"username": user.username, "full_name": user.full_name}, headers=headers)
 
 
 @app.get("/api/companies")
 def list_companies(
-    user: User = Depends(get_current_user),
+    user: AuthUser = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
     rows = db.scalars(
@@ -659,7 +1211,7 @@ def create_company(
     legal_name: str = Form(default=""),
     tax_id: str = Form(default=""),
     business_line: str = Form(default=""),
-    user: User = Depends(get_current_user),
+    user: AuthUser = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
     clean_name = name.strip()
@@ -693,7 +1245,7 @@ def create_company(
 @app.get("/api/vaults")
 def list_vaults(
     company_id: Optional[int] = Query(default=None),
-    user: User = Depends(get_current_user),
+    user: AuthUser = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
     company = resolve_company(user, db, company_id)
@@ -719,7 +1271,7 @@ def create_vault(
     company_id: Optional[int] = Query(default=None),
     name: str = Form(...),
     period_type: str = Form(default="custom"),
-    user: User = Depends(get_current_user),
+    user: AuthUser = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
     company = resolve_company(user, db, company_id)
@@ -757,80 +1309,40 @@ def create_vault(
 def upload_excel(
     enforce_period_check: bool = Query(default=False),
     allow_period_update: bool = Query(default=False),
+    retain_file: bool = Query(default=False),
     company_id: Optional[int] = Query(default=None),
     vault_id: Optional[int] = Query(default=None),
     file: UploadFile = File(...),
-    user: User = Depends(get_current_user),
+    user: AuthUser = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
     if not file.filename.lower().endswith((".xlsx", ".xls")):
         raise HTTPException(status_code=400, detail="Archivo no soportado")
 
-    content = file.file.read()
     company = resolve_company(user, db, company_id)
     vault = resolve_vault(user, db, company, vault_id)
-    user_upload_dir = UPLOADS_DIR / str(user.id)
-    user_upload_dir.mkdir(parents=True, exist_ok=True)
-    safe_name = re.sub(r"[^a-zA-Z0-9._-]", "_", file.filename)
-    file_token = datetime.now(timezone.utc).strftime("%Y%m%d_%H%M%S") + "_" + uuid4().hex[:8]
-    stored_filename = f"{file_token}_{safe_name}"
-    stored_path = user_upload_dir / stored_filename
-    stored_path.write_bytes(content)
-
-    sheet_frames = pd.read_excel(io.BytesIO(content), sheet_name=None, header=None)
-
-    aliases = {
-        "mes": ["mes", "month"],
-        "fecha": ["fecha", "date", "fec"],
-        "cuenta": ["cuenta", "account"],
-        "categoria": ["categoria", "category", "linea_de_negocio", "categoria_", "linea_de_negocios"],
-        "subcategoria": ["subcategoria", "sub_category", "subcategory", "subtipo_de_movimiento", "etapa_de_linea_de_negocio"],
-        "codigo_proyecto": ["codigo_de_proyecto", "codigo_proyecto", "project_code", "cod_proyecto"],
-        "proyecto": ["proyecto", "project", "nombre_de_proyecto", "nombre_proyecto", "proyecto_nombre", "obra", "item"],
-        "emisor_receptor": ["emisor_receptor", "emisor___receptor", "emisor_o_receptor", "counterparty"],
-        "descripcion": ["descripcion", "description", "detalle", "concepto"],
-        "tipo_documento": ["tipo_de_documento", "tipo_documento", "document_type"],
-        "numero_documento": ["numero_de_documento", "numero_documento", "document_number", "n_documento"],
-        "tipo": ["tipo", "type", "flujo", "flow_type", "tipo_de_movimiento"],
-        "monto": ["monto", "amount", "valor", "importe"],
-        "entrada_neta": ["entradas_netas", "entrada_neta", "entrada", "entradas_brutas"],
-        "salida_neta": ["salida_neta", "salida", "salidas_netas", "salidas_brutas"],
-        "verificado": ["verificado", "checked", "validado"],
-        "comentarios": ["comentarios", "comentario", "comments", "observaciones"],
-        "saldo": ["saldo", "balance"],
-    }
-    flow_aliases = {"ingreso": "ingreso", "egreso": "egreso", "entrada": "ingreso", "salida": "egreso"}
-
-    prepared_frames: list[tuple[pd.DataFrame, dict[str, str]]] = []
-
-    for raw_sheet in sheet_frames.values():
-        dataframe = extract_sheet_as_table(raw_sheet)
-        if dataframe is None or dataframe.empty:
-            continue
-
-        normalized_to_original = {normalize_column_name(str(c)): c for c in dataframe.columns}
-        column_map = {}
-        for canonical, candidates in aliases.items():
-            matched = next((candidate for candidate in candidates if candidate in normalized_to_original), None)
-            if matched:
-                column_map[canonical] = normalized_to_original[matched]
-
-        mandatory = {"fecha", "categoria", "tipo"}
-        if not mandatory.issubset(set(column_map.keys())):
-            continue
-
-        has_amount = "monto" in column_map or ("entrada_neta" in column_map and "salida_neta" in column_map)
-        if not has_amount:
-            continue
-
-        prepared_frames.append((dataframe, column_map))
+    stored_path: Optional[Path] = None
+    workbook_source: Path | BinaryIO = file.file
+    if retain_file:
+        user_upload_dir = UPLOADS_DIR / str(user.id)
+        user_upload_dir.mkdir(parents=True, exist_ok=True)
+        safe_name = UNSAFE_FILENAME_PATTERN.sub("_", file.filename)
+        file_token = datetime.now(timezone.utc).strftime("%Y%m%d_%H%M%S") + "_" + uuid4().hex[:8]
+        stored_path = user_upload_dir / f"{file_token}_{safe_name}"
+        with stored_path.open("wb") as stored_file:
+            shutil.copyfileobj(file.file, stored_file, length=UPLOAD_COPY_CHUNK_SIZE)
+        workbook_source = stored_path
 
     batch = UploadBatch(
         owner_id=user.id,
         company_id=company.id,
         vault_id=vault.id,
         original_filename=file.filename,
-        stored_path=str(stored_path.relative_to(Path.cwd())) if stored_path.is_absolute() else str(stored_path),
+        stored_path=(
+            ""
+            if stored_path is None
+            else str(stored_path.relative_to(Path.cwd())) if stored_path.is_absolute() else str(stored_path)
+        ),
     )
     db.add(batch)
     db.flush()
@@ -840,42 +1352,37 @@ def upload_excel(
     replaced_rows = 0
     header_found = False
 
-    for dataframe, column_map in prepared_frames:
+    for raw_sheet in iter_workbook_sheets(workbook_source, Path(file.filename).suffix):
+        dataframe = extract_sheet_as_table(raw_sheet)
+        del raw_sheet
+        if dataframe is None or dataframe.empty:
+            continue
+
+        column_map = match_upload_columns(dataframe.columns)
+
+        if not REQUIRED_UPLOAD_COLUMNS.issubset(column_map.keys()):
+            continue
+
+        has_amount = "monto" in column_map or ("entrada_neta" in column_map and "salida_neta" in column_map)
+        if not has_amount:
+            continue
 
         header_found = True
 
-        period_samples: list[str] = []
+        sheet_records = prepare_sheet_records(dataframe, column_map)
 
         detected_period = None
         detected_month_start: Optional[date] = None
         detected_next_month_start: Optional[date] = None
-        for _, row in dataframe.iterrows():
-            try:
-                flow_raw = str(row[column_map["tipo"]]).strip().lower()
-                flow_type = flow_aliases.get(flow_raw)
-                if flow_type not in {"ingreso", "egreso"}:
-                    continue
-
-                if "monto" in column_map:
-                    _ = parse_amount(row[column_map["monto"]])
-                elif flow_type == "ingreso":
-                    _ = parse_amount(row[column_map["entrada_neta"]])
-                else:
-                    _ = parse_amount(row[column_map["salida_neta"]])
-
-                parsed_date = parse_excel_date(row[column_map["fecha"]])
-                detected_month_start = parsed_date.replace(day=1)
-                detected_next_month_start = (
-                    date(parsed_date.year + 1, 1, 1)
-                    if parsed_date.month == 12
-                    else date(parsed_date.year, parsed_date.month + 1, 1)
-                )
-                month_column = column_map.get("mes")
-                detected_period = normalize_text_value(row[month_column], parsed_date.strftime("%Y-%m")) if month_column else parsed_date.strftime("%Y-%m")
-                if detected_period:
-                    break
-            except Exception:
-                continue
+        if not sheet_records.empty:
+            parsed_date = sheet_records["date"].iat[0]
+            detected_month_start = parsed_date.replace(day=1)
+            detected_next_month_start = (
+                date(parsed_date.year + 1, 1, 1)
+                if parsed_date.month == 12
+                else date(parsed_date.year, parsed_date.month + 1, 1)
+            )
+            detected_period = sheet_records["month"].iat[0]
 
         if detected_period:
             existing_period_batch = db.scalar(
@@ -889,7 +1396,8 @@ def upload_excel(
                 .order_by(UploadBatch.uploaded_at.desc())
             )
             if existing_period_batch and enforce_period_check and not allow_period_update:
-                stored_path.unlink(missing_ok=True)
+                if stored_path is not None:
+                    stored_path.unlink(missing_ok=True)
                 raise HTTPException(
                     status_code=409,
                     detail=(
@@ -909,140 +1417,30 @@ def upload_excel(
                 )
                 replaced_rows += replaced_result.rowcount if replaced_result.rowcount and replaced_result.rowcount > 0 else 0
 
-        existing_rows = db.execute(
-            select(
-                AccountingRecord.date,
-                AccountingRecord.account,
-                AccountingRecord.category,
-                AccountingRecord.subcategory,
-                AccountingRecord.project,
-                AccountingRecord.project_code,
-                AccountingRecord.description,
-                AccountingRecord.flow_type,
-                AccountingRecord.amount,
-                AccountingRecord.document_number,
-            ).where(AccountingRecord.owner_id == user.id)
-            .where(AccountingRecord.company_id == company.id)
-            .where(AccountingRecord.vault_id == vault.id)
-        ).all()
-        existing_fingerprints = {
-            build_record_fingerprint(
-                user.id,
-                row_data[0],
-                row_data[1] or "General",
-                row_data[2] or "",
-                row_data[3] or "General",
-                row_data[4] or "Sin proyecto",
-                row_data[5] or "",
-                row_data[6] or "",
-                row_data[7] or "",
-                float(row_data[8] or 0),
-                row_data[9] or "",
-            )
-            for row_data in existing_rows
-        }
+        if not batch.period_label:
+            non_empty_periods = sheet_records["month"].loc[sheet_records["month"].astype(bool)]
+            if not non_empty_periods.empty:
+                batch.period_label = non_empty_periods.min()
 
-        for _, row in dataframe.iterrows():
-            try:
-                flow_raw = str(row[column_map["tipo"]]).strip().lower()
-                flow_type = flow_aliases.get(flow_raw)
-                if flow_type not in {"ingreso", "egreso"}:
-                    continue
-
-                if "monto" in column_map:
-                    amount = parse_amount(row[column_map["monto"]])
-                elif flow_type == "ingreso":
-                    amount = parse_amount(row[column_map["entrada_neta"]])
-                else:
-                    amount = parse_amount(row[column_map["salida_neta"]])
-
-                description_column = column_map.get("descripcion")
-                subcategory_column = column_map.get("subcategoria")
-                project_column = column_map.get("proyecto")
-                month_column = column_map.get("mes")
-                account_column = column_map.get("cuenta")
-                project_code_column = column_map.get("codigo_proyecto")
-                counterparty_column = column_map.get("emisor_receptor")
-                document_type_column = column_map.get("tipo_documento")
-                document_number_column = column_map.get("numero_documento")
-                verified_column = column_map.get("verificado")
-                comments_column = column_map.get("comentarios")
-                balance_column = column_map.get("saldo")
-
-                description = normalize_text_value(row[description_column], "") if description_column else ""
-                subcategory = normalize_text_value(row[subcategory_column], "General") if subcategory_column else "General"
-                project = normalize_text_value(row[project_column], "Sin proyecto") if project_column else "Sin proyecto"
-                account = normalize_text_value(row[account_column], "General") if account_column else "General"
-                project_code = normalize_text_value(row[project_code_column], "") if project_code_column else ""
-                counterparty = normalize_text_value(row[counterparty_column], "") if counterparty_column else ""
-                document_type = normalize_text_value(row[document_type_column], "") if document_type_column else ""
-                document_number = normalize_text_value(row[document_number_column], "") if document_number_column else ""
-                verified = normalize_text_value(row[verified_column], "") if verified_column else ""
-                comments = normalize_text_value(row[comments_column], "") if comments_column else ""
-
-                parsed_date = parse_excel_date(row[column_map["fecha"]])
-                month = normalize_text_value(row[month_column], parsed_date.strftime("%Y-%m")) if month_column else parsed_date.strftime("%Y-%m")
-                period_samples.append(month)
-
-                balance = parse_amount(row[balance_column]) if balance_column else 0.0
-
-                if not description:
-                    description = f"{str(row[column_map['categoria']]).strip()} - {subcategory}"
-
-                source_filename = file.filename
-                fingerprint = build_record_fingerprint(
-                    user.id,
-                    parsed_date,
-                    account,
-                    str(row[column_map["categoria"]]).strip(),
-                    subcategory,
-                    project,
-                    project_code,
-                    description,
-                    flow_type,
-                    amount,
-                    document_number,
-                )
-                if fingerprint in existing_fingerprints:
-                    duplicates += 1
-                    continue
-                existing_fingerprints.add(fingerprint)
-
-                record = AccountingRecord(
-                    owner_id=user.id,
-                    company_id=company.id,
-                    vault_id=vault.id,
-                    upload_batch_id=batch.id,
-                    date=parsed_date,
-                    month=month,
-                    account=account,
-                    category=str(row[column_map["categoria"]]).strip(),
-                    subcategory=subcategory,
-                    project=project,
-                    project_code=project_code,
-                    counterparty=counterparty,
-                    description=description,
-                    document_type=document_type,
-                    document_number=document_number,
-                    flow_type=flow_type,
-                    verified=verified,
-                    comments=comments,
-                    amount=amount,
-                    balance=balance,
-                    source_filename=source_filename,
-                )
-            except Exception:
-                continue
-            db.add(record)
-            created += 1
+        candidate_records = sheet_records.loc[sheet_records["balance"].notna()]
+        if candidate_records.empty:
+            continue
 
-        if period_samples and not batch.period_label:
-            non_empty_periods = [item for item in period_samples if item]
-            if non_empty_periods:
-                batch.period_label = sorted(set(non_empty_periods))[0]
+        new_rows = candidate_records.assign(
+            fingerprint=build_record_fingerprints(candidate_records),
+            owner_id=user.id,
+            company_id=company.id,
+            vault_id=vault.id,
+            upload_batch_id=batch.id,
+            source_filename=file.filename,
+        ).to_dict("records")
+        inserted = insert_accounting_records(db, new_rows)
+        created += inserted
+        duplicates += len(new_rows) - inserted
 
     if not header_found:
-        stored_path.unlink(missing_ok=True)
+        if stored_path is not None:
+            stored_path.unlink(missing_ok=True)
         raise HTTPException(
             status_code=400,
             detail="No se detectaron columnas válidas en el Excel. Usa el formato estándar o el formato de flujo de caja con cabecera FECHA/TIPO DE MOVIMIENTO.",
@@ -1055,6 +1453,7 @@ def upload_excel(
     if allow_period_update and batch.period_label:
         batch.period_label = f"{batch.period_label} (actualizado)"
 
+    bump_vault_data_version(db, vault)
     db.commit()
     return {
         "message": "Carga completada",
@@ -1070,7 +1469,7 @@ def upload_excel(
 def uploads_history(
     company_id: Optional[int] = Query(default=None),
     vault_id: Optional[int] = Query(default=None),
-    user: User = Depends(get_current_user),
+    user: AuthUser = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
     company = resolve_company(user, db, company_id)
@@ -1082,6 +1481,7 @@ def uploads_history(
         .where(UploadBatch.vault_id == vault.id)
         .order_by(UploadBatch.uploaded_at.desc())
         .limit(100)
+        .options(raiseload("*"))
     ).all()
     return [
         {
@@ -1112,7 +1512,7 @@ def clear_records(
     date_from: Optional[str] = Query(default=None),
     date_to: Optional[str] = Query(default=None),
     search: Optional[str] = Query(default=None),
-    user: User = Depends(get_current_user),
+    user: AuthUser = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
     company = resolve_company(user, db, company_id)
@@ -1121,9 +1521,10 @@ def clear_records(
         AccountingRecord.owner_id == user.id,
         AccountingRecord.company_id == company.id,
         AccountingRecord.vault_id == vault.id,
+        *build_record_filter_clauses(category, subcategory, project, account, project_code, year, month_number, flow_type, date_from, date_to, search),
     )
-    statement = apply_record_filters(statement, category, subcategory, project, account, project_code, year, month_number, flow_type, date_from, date_to, search)
     result = db.execute(statement)
+    bump_vault_data_version(db, vault)
     db.commit()
     deleted_rows = result.rowcount if result.rowcount and result.rowcount > 0 else 0
     return {"message": "Datos eliminados", "deleted_rows": deleted_rows}
@@ -1144,20 +1545,31 @@ def records(
     date_from: Optional[str] = Query(default=None),
     date_to: Optional[str] = Query(default=None),
     search: Optional[str] = Query(default=None),
+    cursor_date: Optional[str] = Query(default=None),
+    cursor_id: Optional[int] = Query(default=None),
     limit: int = Query(default=200, le=1000),
-    user: User = Depends(get_current_user),
+    user: AuthUser = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
     company = resolve_company(user, db, company_id)
     vault = resolve_vault(user, db, company, vault_id)
-    query = select(AccountingRecord).where(
+    query = select(AccountingRecord).options(raiseload("*")).where(
         AccountingRecord.owner_id == user.id,
         AccountingRecord.company_id == company.id,
         AccountingRecord.vault_id == vault.id,
+        *build_record_filter_clauses(category, subcategory, project, account, project_code, year, month_number, flow_type, date_from, date_to, search),
     )
-    query = apply_record_filters(query, category, subcategory, project, account, project_code, year, month_number, flow_type, date_from, date_to, search)
 
-    query = query.order_by(AccountingRecord.date.desc()).limit(limit)
+    if (cursor_date is None) != (cursor_id is None):
+        raise HTTPException(status_code=400, detail="El cursor requiere cursor_date y cursor_id")
+    if cursor_date is not None:
+        try:
+            cursor_day = datetime.fromisoformat(cursor_date).date()
+        except ValueError:
+            raise HTTPException(status_code=400, detail="cursor_date debe tener formato AAAA-MM-DD")
+        query = query.where(tuple_(AccountingRecord.date, AccountingRecord.id) < tuple_(cursor_day, cursor_id))
+
+    query = query.order_by(AccountingRecord.date.desc(), AccountingRecord.id.desc()).limit(limit)
     result = db.scalars(query).all()
 
     return [
@@ -1202,36 +1614,19 @@ def records_page(
     search: Optional[str] = Query(default=None),
     page: int = Query(default=1, ge=1),
     page_size: int = Query(default=100, ge=1, le=1000),
-    user: User = Depends(get_current_user),
+    user: AuthUser = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
     company = resolve_company(user, db, company_id)
     vault = resolve_vault(user, db, company, vault_id)
-    base_query = select(AccountingRecord).where(
+    record_filters = (
         AccountingRecord.owner_id == user.id,
         AccountingRecord.company_id == company.id,
         AccountingRecord.vault_id == vault.id,
+        *build_record_filter_clauses(category, subcategory, project, account, project_code, year, month_number, flow_type, date_from, date_to, search),
     )
-    base_query = apply_record_filters(base_query, category, subcategory, project, account, project_code, year, month_number, flow_type, date_from, date_to, search)
-
-    count_query = apply_record_filters(
-        select(func.count()).select_from(AccountingRecord).where(
-            AccountingRecord.owner_id == user.id,
-            AccountingRecord.company_id == company.id,
-            AccountingRecord.vault_id == vault.id,
-        ),
-        category,
-        subcategory,
-        project,
-        account,
-        project_code,
-        year,
-        month_number,
-        flow_type,
-        date_from,
-        date_to,
-        search,
-    )
+    base_query = select(AccountingRecord).options(raiseload("*")).where(*record_filters)
+    count_query = select(func.count()).select_from(AccountingRecord).where(*record_filters)
     total = int(db.scalar(count_query) or 0)
 
     offset = (page - 1) * page_size
@@ -1272,6 +1667,7 @@ def records_page(
 
 @app.get("/api/data/summary")
 def summary(
+    request: Request,
     company_id: Optional[int] = Query(default=None),
     vault_id: Optional[int] = Query(default=None),
     category: Optional[str] = Query(default=None),
@@ -1285,43 +1681,17 @@ def summary(
     date_from: Optional[str] = Query(default=None),
     date_to: Optional[str] = Query(default=None),
     search: Optional[str] = Query(default=None),
-    user: User = Depends(get_current_user),
+    user: AuthUser = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
     company = resolve_company(user, db, company_id)
     vault = resolve_vault(user, db, company, vault_id)
-    category_query = apply_record_filters(
-        select(AccountingRecord.category, func.sum(AccountingRecord.amount))
-        .where(
-            AccountingRecord.owner_id == user.id,
-            AccountingRecord.company_id == company.id,
-            AccountingRecord.vault_id == vault.id,
-        )
-        .group_by(AccountingRecord.category)
-        .order_by(func.sum(AccountingRecord.amount).desc()),
-        category,
-        subcategory,
-        project,
-        account,
-        project_code,
-        year,
-        month_number,
-        flow_type,
-        date_from,
-        date_to,
-        search,
+    scope_filters = (
+        AccountingRecord.owner_id == user.id,
+        AccountingRecord.company_id == company.id,
+        AccountingRecord.vault_id == vault.id,
     )
-    by_category = db.execute(category_query).all()
-
-    month_query = apply_record_filters(
-        select(AccountingRecord.month, func.sum(AccountingRecord.amount))
-        .where(
-            AccountingRecord.owner_id == user.id,
-            AccountingRecord.company_id == company.id,
-            AccountingRecord.vault_id == vault.id,
-        )
-        .group_by(AccountingRecord.month)
-        .order_by(AccountingRecord.month),
+    record_filters = (
         category,
         subcategory,
         project,
@@ -1334,57 +1704,85 @@ def summary(
         date_to,
         search,
     )
-    by_month = db.execute(month_query).all()
-
-    flow_query = apply_record_filters(
-        select(AccountingRecord.flow_type, func.sum(AccountingRecord.amount))
-        .where(
-            AccountingRecord.owner_id == user.id,
-            AccountingRecord.company_id == company.id,
-            AccountingRecord.vault_id == vault.id,
+    etag = '"' + hashlib.sha256(f"{user.id}:{vault.id}:{vault.data_version}:{record_filters}".encode("utf-8")).hexdigest()[:32] + '"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    now = time.time()
+    cache_key = ("summary", vault.id, vault.data_version, record_filters)
+    cached_summary = cache_get(dashboard_cache, cache_key, now)
+    if cached_summary is not None:
+        return ORJSONResponse(cached_summary, headers=headers)
+
+    filter_clauses = build_record_filter_clauses(*record_filters)
+    by_category: dict[str, float] = {}
+    by_month: dict[str, float] = {}
+    by_flow: dict[str, float] = {}
+    if engine.dialect.name == "postgresql":
+        grouped_query = (
+            select(
+                AccountingRecord.category,
+                AccountingRecord.month,
+                AccountingRecord.flow_type,
+                func.grouping(AccountingRecord.category),
+                func.grouping(AccountingRecord.month),
+                func.sum(AccountingRecord.amount),
+            )
+            .where(*scope_filters, *filter_clauses)
+            .group_by(
+                func.grouping_sets(
+                    tuple_(AccountingRecord.category),
+                    tuple_(AccountingRecord.month),
+                    tuple_(AccountingRecord.flow_type),
+                )
+            )
         )
-        .group_by(AccountingRecord.flow_type),
-        category,
-        subcategory,
-        project,
-        account,
-        project_code,
-        year,
-        month_number,
-        flow_type,
-        date_from,
-        date_to,
-        search,
-    )
-    by_flow = db.execute(flow_query).all()
-
-    return {
-        "by_category": [{"label": row[0], "value": float(row[1])} for row in by_category],
-        "by_month": [{"label": row[0], "value": float(row[1])} for row in by_month],
-        "by_flow": [{"label": row[0], "value": float(row[1])} for row in by_flow],
+        for category_label, month_label, flow_label, category_grouping, month_grouping, amount in db.execute(grouped_query):
+            if category_grouping == 0:
+                by_category[category_label] = amount
+            elif month_grouping == 0:
+                by_month[month_label] = amount
+            else:
+                by_flow[flow_label] = amount
+    else:
+        grouped_query = (
+            select(
+                AccountingRecord.category,
+                AccountingRecord.month,
+                AccountingRecord.flow_type,
+                func.sum(AccountingRecord.amount),
+            )
+            .where(*scope_filters, *filter_clauses)
+            .group_by(AccountingRecord.category, AccountingRecord.month, AccountingRecord.flow_type)
+        )
+        for category_label, month_label, flow_label, amount in db.execute(grouped_query):
+            by_category[category_label] = by_category.get(category_label, 0.0) + amount
+            by_month[month_label] = by_month.get(month_label, 0.0) + amount
+            by_flow[flow_label] = by_flow.get(flow_label, 0.0) + amount
+
+    payload = {
+        "by_category": [
+            {"label": label, "value": float(value)}
+            for label, value in sorted(by_category.items(), key=lambda item: item[1], reverse=True)
+        ],
+        "by_month": [{"label": label, "value": float(value)} for label, value in sorted(by_month.items())],
+        "by_flow": [{"label": label, "value": float(value)} for label, value in sorted(by_flow.items())],
     }
+    cache_set(dashboard_cache, cache_key, payload, now + DASHBOARD_CACHE_SECONDS, now, DASHBOARD_CACHE_MAX_ENTRIES)
+    return ORJSONResponse(payload, headers=headers)
 
 
 @app.get("/api/data/categories")
 def categories(
     company_id: Optional[int] = Query(default=None),
     vault_id: Optional[int] = Query(default=None),
-    user: User = Depends(get_current_user),
+    user: AuthUser = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
     company = resolve_company(user, db, company_id)
     vault = resolve_vault(user, db, company, vault_id)
-    result = db.execute(
-        select(AccountingRecord.category)
-        .where(
-            AccountingRecord.owner_id == user.id,
-            AccountingRecord.company_id == company.id,
-            AccountingRecord.vault_id == vault.id,
-        )
-        .group_by(AccountingRecord.category)
-        .order_by(AccountingRecord.category.asc())
-    ).all()
-    return [row[0] for row in result]
+    return cached_record_facets(db, user, company, vault, None)["categories"]
 
 
 @app.get("/api/data/subcategories")
@@ -1392,20 +1790,12 @@ def subcategories(
     company_id: Optional[int] = Query(default=None),
     vault_id: Optional[int] = Query(default=None),
     category: Optional[str] = Query(default=None),
-    user: User = Depends(get_current_user),
+    user: AuthUser = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
     company = resolve_company(user, db, company_id)
     vault = resolve_vault(user, db, company, vault_id)
-    query = select(AccountingRecord.subcategory).where(
-        AccountingRecord.owner_id == user.id,
-        AccountingRecord.company_id == company.id,
-        AccountingRecord.vault_id == vault.id,
-    )
-    if category:
-        query = query.where(AccountingRecord.category == category)
-    result = db.execute(query.group_by(AccountingRecord.subcategory).order_by(AccountingRecord.subcategory.asc())).all()
-    return [row[0] for row in result if row[0]]
+    return cached_record_facets(db, user, company, vault, category)["subcategories"]
 
 
 @app.get("/api/data/projects")
@@ -1413,86 +1803,48 @@ def projects(
     company_id: Optional[int] = Query(default=None),
     vault_id: Optional[int] = Query(default=None),
     category: Optional[str] = Query(default=None),
-    user: User = Depends(get_current_user),
+    user: AuthUser = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
     company = resolve_company(user, db, company_id)
     vault = resolve_vault(user, db, company, vault_id)
-    query = select(AccountingRecord.project).where(
-        AccountingRecord.owner_id == user.id,
-        AccountingRecord.company_id == company.id,
-        AccountingRecord.vault_id == vault.id,
-    )
-    if category:
-        query = query.where(AccountingRecord.category == category)
-    result = db.execute(query.group_by(AccountingRecord.project).order_by(AccountingRecord.project.asc())).all()
-    return [row[0] for row in result if row[0]]
+    return cached_record_facets(db, user, company, vault, category)["projects"]
 
 
 @app.get("/api/data/accounts")
 def accounts(
     company_id: Optional[int] = Query(default=None),
     vault_id: Optional[int] = Query(default=None),
-    user: User = Depends(get_current_user),
+    user: AuthUser = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
     company = resolve_company(user, db, company_id)
     vault = resolve_vault(user, db, company, vault_id)
-    result = db.execute(
-        select(AccountingRecord.account)
-        .where(
-            AccountingRecord.owner_id == user.id,
-            AccountingRecord.company_id == company.id,
-            AccountingRecord.vault_id == vault.id,
-        )
-        .group_by(AccountingRecord.account)
-        .order_by(AccountingRecord.account.asc())
-    ).all()
-    return [row[0] for row in result if row[0]]
+    return cached_record_facets(db, user, company, vault, None)["accounts"]
 
 
 @app.get("/api/data/project-codes")
 def project_codes(
     company_id: Optional[int] = Query(default=None),
     vault_id: Optional[int] = Query(default=None),
-    user: User = Depends(get_current_user),
+    user: AuthUser = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
     company = resolve_company(user, db, company_id)
     vault = resolve_vault(user, db, company, vault_id)
-    result = db.execute(
-        select(AccountingRecord.project_code)
-        .where(
-            AccountingRecord.owner_id == user.id,
-            AccountingRecord.company_id == company.id,
-            AccountingRecord.vault_id == vault.id,
-        )
-        .group_by(AccountingRecord.project_code)
-        .order_by(AccountingRecord.project_code.asc())
-    ).all()
-    return [row[0] for row in result if row[0]]
+    return cached_record_facets(db, user, company, vault, None)["project_codes"]
 
 
 @app.get("/api/data/years")
 def years(
     company_id: Optional[int] = Query(default=None),
     vault_id: Optional[int] = Query(default=None),
-    user: User = Depends(get_current_user),
+    user: AuthUser = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
     company = resolve_company(user, db, company_id)
     vault = resolve_vault(user, db, company, vault_id)
-    result = db.execute(
-        select(extract("year", AccountingRecord.date))
-        .where(
-            AccountingRecord.owner_id == user.id,
-            AccountingRecord.company_id == company.id,
-            AccountingRecord.vault_id == vault.id,
-        )
-        .group_by(extract("year", AccountingRecord.date))
-        .order_by(extract("year", AccountingRecord.date).desc())
-    ).all()
-    return [str(int(row[0])) for row in result if row[0] is not None]
+    return cached_record_facets(db, user, company, vault, None)["years"]
 
 
 @app.get("/api/data/options")
@@ -1500,77 +1852,13 @@ def data_options(
     company_id: Optional[int] = Query(default=None),
     vault_id: Optional[int] = Query(default=None),
     category: Optional[str] = Query(default=None),
-    user: User = Depends(get_current_user),
+    user: AuthUser = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
     company = resolve_company(user, db, company_id)
     vault = resolve_vault(user, db, company, vault_id)
 
-    categories_rows = db.execute(
-        select(AccountingRecord.category)
-        .where(
-            AccountingRecord.owner_id == user.id,
-            AccountingRecord.company_id == company.id,
-            AccountingRecord.vault_id == vault.id,
-        )
-        .group_by(AccountingRecord.category)
-        .order_by(AccountingRecord.category.asc())
-    ).all()
-
-    subcategories_query = select(AccountingRecord.subcategory).where(
-        AccountingRecord.owner_id == user.id,
-        AccountingRecord.company_id == company.id,
-        AccountingRecord.vault_id == vault.id,
-    )
-    if category:
-        subcategories_query = subcategories_query.where(AccountingRecord.category == category)
-    subcategories_rows = db.execute(
-        subcategories_query.group_by(AccountingRecord.subcategory).order_by(AccountingRecord.subcategory.asc())
-    ).all()
-
-    projects_query = select(AccountingRecord.project).where(
-        AccountingRecord.owner_id == user.id,
-        AccountingRecord.company_id == company.id,
-        AccountingRecord.vault_id == vault.id,
-    )
-    if category:
-        projects_query = projects_query.where(AccountingRecord.category == category)
-    projects_rows = db.execute(
-        projects_query.group_by(AccountingRecord.project).order_by(AccountingRecord.project.asc())
-    ).all()
-
-    accounts_rows = db.execute(
-        select(AccountingRecord.account)
-        .where(
-            AccountingRecord.owner_id == user.id,
-            AccountingRecord.company_id == company.id,
-            AccountingRecord.vault_id == vault.id,
-        )
-        .group_by(AccountingRecord.account)
-        .order_by(AccountingRecord.account.asc())
-    ).all()
-
-    project_codes_rows = db.execute(
-        select(AccountingRecord.project_code)
-        .where(
-            AccountingRecord.owner_id == user.id,
-            AccountingRecord.company_id == company.id,
-            AccountingRecord.vault_id == vault.id,
-        )
-        .group_by(AccountingRecord.project_code)
-        .order_by(AccountingRecord.project_code.asc())
-    ).all()
-
-    years_rows = db.execute(
-        select(extract("year", AccountingRecord.date))
-        .where(
-            AccountingRecord.owner_id == user.id,
-            AccountingRecord.company_id == company.id,
-            AccountingRecord.vault_id == vault.id,
-        )
-        .group_by(extract("year", AccountingRecord.date))
-        .order_by(extract("year", AccountingRecord.date).desc())
-    ).all()
+    facets = cached_record_facets(db, user, company, vault, category)
 
     uploads_rows = db.scalars(
         select(UploadBatch)
@@ -1579,15 +1867,11 @@ def data_options(
         .where(UploadBatch.vault_id == vault.id)
         .order_by(UploadBatch.uploaded_at.desc())
         .limit(100)
+        .options(raiseload("*"))
     ).all()
 
     return {
-        "categories": [row[0] for row in categories_rows if row[0]],
-        "subcategories": [row[0] for row in subcategories_rows if row[0]],
-        "projects": [row[0] for row in projects_rows if row[0]],
-        "accounts": [row[0] for row in accounts_rows if row[0]],
-        "project_codes": [row[0] for row in project_codes_rows if row[0]],
-        "years": [str(int(row[0])) for row in years_rows if row[0] is not None],
+        **facets,
         "uploads": [
             {
                 "id": item.id,
@@ -1618,17 +1902,12 @@ def detailed_report(
     date_from: Optional[str] = Query(default=None),
     date_to: Optional[str] = Query(default=None),
     search: Optional[str] = Query(default=None),
-    user: User = Depends(get_current_user),
+    user: AuthUser = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
     company = resolve_company(user, db, company_id)
     vault = resolve_vault(user, db, company, vault_id)
-    filtered_base = apply_record_filters(
-        select(AccountingRecord).where(
-            AccountingRecord.owner_id == user.id,
-            AccountingRecord.company_id == company.id,
-            AccountingRecord.vault_id == vault.id,
-        ),
+    record_filters = (
         category,
         subcategory,
         project,
@@ -1641,58 +1920,50 @@ def detailed_report(
         date_to,
         search,
     )
-    records = db.scalars(filtered_base.order_by(AccountingRecord.date.desc())).all()
-
-    income_total = sum(record.amount for record in records if record.flow_type == "ingreso")
-    expense_total = sum(record.amount for record in records if record.flow_type == "egreso")
-    balance = income_total - expense_total
+    now = time.time()
+    cache_key = ("report", vault.id, vault.data_version, record_filters)
+    cached_report = cache_get(dashboard_cache, cache_key, now)
+    if cached_report is not None:
+        return cached_report
 
-    by_category_rows = db.execute(
-        apply_record_filters(
-            select(AccountingRecord.category, func.sum(AccountingRecord.amount))
-            .where(
-                AccountingRecord.owner_id == user.id,
-                AccountingRecord.company_id == company.id,
-                AccountingRecord.vault_id == vault.id,
-            )
-            .group_by(AccountingRecord.category)
-            .order_by(func.sum(AccountingRecord.amount).desc()),
-            category,
-            subcategory,
-            project,
-            account,
-            project_code,
-            year,
-            month_number,
-            flow_type,
-            date_from,
-            date_to,
-            search,
+    filters = (
+        AccountingRecord.owner_id == user.id,
+        AccountingRecord.company_id == company.id,
+        AccountingRecord.vault_id == vault.id,
+        *build_record_filter_clauses(*record_filters),
+    )
+    top_categories = (
+        select(
+            AccountingRecord.category.label("label"),
+            func.sum(AccountingRecord.amount).label("amount"),
+            func.count().label("records"),
         )
-    ).all()
-
-    by_flow_rows = db.execute(
-        apply_record_filters(
-            select(AccountingRecord.flow_type, func.sum(AccountingRecord.amount))
-            .where(
-                AccountingRecord.owner_id == user.id,
-                AccountingRecord.company_id == company.id,
-                AccountingRecord.vault_id == vault.id,
-            )
+        .where(*filters)
+        .group_by(AccountingRecord.category)
+        .order_by(func.sum(AccountingRecord.amount).desc())
+        .limit(5)
+        .subquery()
+    )
+    report_rows = db.execute(
+        union_all(
+            select(literal("category").label("kind"), top_categories.c.label, top_categories.c.amount, top_categories.c.records),
+            select(literal("flow"), AccountingRecord.flow_type, func.sum(AccountingRecord.amount), func.count())
+            .where(*filters)
             .group_by(AccountingRecord.flow_type),
-            category,
-            subcategory,
-            project,
-            account,
-            project_code,
-            year,
-            month_number,
-            flow_type,
-            date_from,
-            date_to,
-            search,
-        )
+        ).order_by(literal_column("kind"), literal_column("label"))
     ).all()
+    by_category_rows = sorted(
+        ((row.label, row.amount) for row in report_rows if row.kind == "category"),
+        key=lambda row: row[1],
+        reverse=True,
+    )
+    by_flow_rows = [(row.label, row.amount, row.records) for row in report_rows if row.kind == "flow"]
+
+    flow_totals = {row[0]: float(row[1]) for row in by_flow_rows}
+    income_total = flow_totals.get("ingreso", 0.0)
+    expense_total = flow_totals.get("egreso", 0.0)
+    balance = income_total - expense_total
+    record_count = sum(row[2] for row in by_flow_rows)
 
     top_category = by_category_rows[0][0] if by_category_rows else None
     top_category_amount = float(by_category_rows[0][1]) if by_category_rows else 0.0
@@ -1715,21 +1986,24 @@ def detailed_report(
         elif ratio < 0.6:
             insights.append("La relación egreso/ingreso es saludable (<60%), con capacidad de crecimiento.")
 
-    if len(records) == 0:
+    if record_count == 0:
         insights.append("No hay datos para el filtro actual; amplía rango o criterios para generar conclusiones.")
 
-    return {
+    payload = {
         "totals": {
-            "records": len(records),
+            "records": record_count,
             "income": round(income_total, 2),
             "expense": round(expense_total, 2),
             "balance": round(balance, 2),
         },
         "by_flow": [{"label": row[0], "value": float(row[1])} for row in by_flow_rows],
-        "top_categories": [
-            {"label": row[0], "value": float(row[1])}
-            for row in by_category_rows[:5]
-        ],
+        "top_categories": [{"label": row[0], "value": float(row[1])} for row in by_category_rows],
         "insights": insights,
         "analysis_engine": "deterministic-local",
     }
+    cache_set(dashboard_cache, cache_key, payload, now + DASHBOARD_CACHE_SECONDS, now, DASHBOARD_CACHE_MAX_ENTRIES)
+    return payload
+
+
+if __name__ == "__main__":
+    ensure_schema_evolution()
@@ -0,0 +1,32 @@
+import os
+from uuid import uuid4
+
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app.main import app
+
+
+@pytest.fixture(scope="session")
+def client():
+    with TestClient(app) as test_client:
+        yield test_client
+
+
+@pytest.fixture
+def login(client):
+    def login_as(username=None, password="supersecure123"):
+        username = username or f"user_{uuid4().hex[:12]}"
+        register = client.post(
+            "/api/auth/register",
+            data={"username": username, "full_name": "Test User", "password": password},
+        )
+        assert register.status_code == 200
+        response = client.post("/api/auth/login", data={"username": username, "password": password})
+        assert response.status_code == 200
+        csrf_token = client.cookies.get("csrf_token")
+        return username, {"x-csrf-token": csrf_token} if csrf_token else {}
+
+    return login_as
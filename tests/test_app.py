@@ -1,25 +1,21 @@
+import math
+from datetime import date, datetime, timedelta, timezone
 from io import BytesIO
 
 import pandas as pd
-from fastapi.testclient import TestClient
+import pytest
+import redis
+from jose import jwt
+from openpyxl import Workbook
+from passlib.hash import bcrypt
+from sqlalchemy import select
 
-from app.main import app
+from app import main
+from app.main import BCRYPT_ROUNDS, JWT_ALGORITHM, JWT_SECRET, LOGIN_RATE_LIMIT_MAX_ATTEMPTS, SessionLocal, User, iter_workbook_sheets, parse_amount_series, parse_date_series
 
 
-client = TestClient(app)
-
-
-def test_auth_and_data_flow():
-    register = client.post(
-        "/api/auth/register",
-        data={"username": "tester", "full_name": "Test User", "password": "supersecure123"},
-    )
-    assert register.status_code in (200, 400)
-
-    login = client.post("/api/auth/login", data={"username": "tester", "password": "supersecure123"})
-    assert login.status_code == 200
-    csrf_token = client.cookies.get("csrf_token")
-    csrf_headers = {"x-csrf-token": csrf_token} if csrf_token else {}
+def test_auth_and_data_flow(client, login):
+    _, csrf_headers = login()
 
     df = pd.DataFrame(
         [
@@ -54,9 +50,268 @@ def test_auth_and_data_flow():
 
     records = client.get("/api/data/records")
     assert records.status_code == 200
-    assert isinstance(records.json(), list)
+    assert len(records.json()) == 2
 
     filtered_summary = client.get("/api/data/summary", params={"flow_type": "ingreso"})
     assert filtered_summary.status_code == 200
     payload = filtered_summary.json()
     assert all(item["label"] == "ingreso" for item in payload["by_flow"])
+
+
+def test_me_supports_etag_revalidation(client, login):
+    login()
+
+    first = client.get("/api/me")
+    assert first.status_code == 200
+    etag = first.headers["etag"]
+
+    revalidated = client.get("/api/me", headers={"If-None-Match": etag})
+    assert revalidated.status_code == 304
+    assert revalidated.headers["etag"] == etag
+
+
+def test_records_keyset_pagination(client, login):
+    _, csrf_headers = login()
+    df = pd.DataFrame(
+        [
+            {"fecha": f"2025-04-{day:02d}", "categoria": "Ventas", "tipo": "ingreso", "monto": amount}
+            for day, amount in ((1, 100), (2, 200), (2, 250), (3, 300), (4, 400))
+        ]
+    )
+    buffer = BytesIO()
+    df.to_excel(buffer, index=False)
+    upload = client.post("/api/data/upload", files={"file": ("pages.xlsx", buffer.getvalue())}, headers=csrf_headers)
+    assert upload.status_code == 200
+
+    seen = []
+    params = {"limit": 2}
+    while True:
+        page = client.get("/api/data/records", params=params)
+        assert page.status_code == 200
+        rows = page.json()
+        if not rows:
+            break
+        seen.extend(rows)
+        params = {"limit": 2, "cursor_date": rows[-1]["fecha"], "cursor_id": rows[-1]["id"]}
+    assert [row["fecha"] for row in seen] == ["2025-04-04", "2025-04-03", "2025-04-02", "2025-04-02", "2025-04-01"]
+    assert len({row["id"] for row in seen}) == 5
+
+    bad_cursor = client.get("/api/data/records", params={"cursor_date": "foo", "cursor_id": 1})
+    assert bad_cursor.status_code == 400
+    half_cursor = client.get("/api/data/records", params={"cursor_id": 1})
+    assert half_cursor.status_code == 400
+
+
+def test_tokens_without_uid_resolve_by_username(client, login):
+    username, _ = login()
+    expire = datetime.now(timezone.utc) + timedelta(minutes=5)
+    access = jwt.encode({"sub": username, "type": "access", "exp": expire}, JWT_SECRET, algorithm=JWT_ALGORITHM)
+    refresh = jwt.encode({"sub": username, "type": "refresh", "exp": expire}, JWT_SECRET, algorithm=JWT_ALGORITHM)
+    client.cookies.clear()
+
+    me = client.get("/api/me", headers={"Authorization": f"Bearer {access}"})
+    assert me.status_code == 200
+    assert me.json()["username"] == username
+
+    client.cookies.set("refresh_token", refresh)
+    refreshed = client.post("/api/auth/refresh")
+    assert refreshed.status_code == 200
+    payload = jwt.decode(refreshed.cookies["access_token"], JWT_SECRET, algorithms=[JWT_ALGORITHM])
+    with SessionLocal() as db:
+        assert payload["uid"] == db.scalar(select(User.id).where(User.username == username))
+
+
+def test_summary_etag_changes_after_upload(client, login):
+    _, csrf_headers = login()
+
+    first = client.get("/api/data/summary")
+    assert first.status_code == 200
+    etag = first.headers["etag"]
+
+    revalidated = client.get("/api/data/summary", headers={"If-None-Match": etag})
+    assert revalidated.status_code == 304
+
+    df = pd.DataFrame([{"fecha": "2025-02-03", "categoria": "Arriendo", "tipo": "egreso", "monto": 320}])
+    buffer = BytesIO()
+    df.to_excel(buffer, index=False)
+    upload = client.post("/api/data/upload", files={"file": ("etag.xlsx", buffer.getvalue())}, headers=csrf_headers)
+    assert upload.status_code == 200
+
+    refreshed = client.get("/api/data/summary", headers={"If-None-Match": etag})
+    assert refreshed.status_code == 200
+    assert refreshed.headers["etag"] != etag
+
+
+def test_login_keeps_stronger_hashes_and_upgrades_weak_ones(client, login):
+    username, _ = login()
+
+    def login_with_hash(password_hash):
+        with SessionLocal() as db:
+            user = db.scalar(select(User).where(User.username == username))
+            user.password_hash = password_hash
+            db.commit()
+        response = client.post("/api/auth/login", data={"username": username, "password": "supersecure123"})
+        assert response.status_code == 200
+        with SessionLocal() as db:
+            return db.scalar(select(User.password_hash).where(User.username == username))
+
+    strong_hash = bcrypt.using(rounds=BCRYPT_ROUNDS + 2, ident="2b").hash("supersecure123")
+    assert login_with_hash(strong_hash) == strong_hash
+
+    for weak_hash in (
+        bcrypt.using(rounds=4, ident="2b").hash("supersecure123"),
+        bcrypt.using(rounds=BCRYPT_ROUNDS, ident="2a").hash("supersecure123"),
+    ):
+        upgraded = login_with_hash(weak_hash)
+        assert upgraded != weak_hash
+        assert upgraded.startswith(f"$2b${BCRYPT_ROUNDS:02d}$")
+
+
+class UnavailableRedis:
+    def get(self, key):
+        raise redis.ConnectionError("redis caído")
+
+    def pipeline(self):
+        raise redis.ConnectionError("redis caído")
+
+    def delete(self, key):
+        raise redis.ConnectionError("redis caído")
+
+
+def test_login_rate_limit_falls_back_to_memory_without_redis(client, login, monkeypatch):
+    username, _ = login()
+    monkeypatch.setattr(main, "redis_client", UnavailableRedis())
+    monkeypatch.setattr(main, "login_attempts_by_ip", {})
+
+    for _ in range(LOGIN_RATE_LIMIT_MAX_ATTEMPTS):
+        failed = client.post("/api/auth/login", data={"username": username, "password": "wrongpassword"})
+        assert failed.status_code == 401
+    blocked = client.post("/api/auth/login", data={"username": username, "password": "supersecure123"})
+    assert blocked.status_code == 429
+
+
+def test_upload_skips_duplicate_rows(client, login):
+    _, csrf_headers = login()
+
+    repeated_row = {"fecha": "2025-03-04", "categoria": "Ventas", "descripcion": "Factura B", "tipo": "ingreso", "monto": 800}
+    df = pd.DataFrame(
+        [
+            repeated_row,
+            repeated_row,
+            {"fecha": "2025-03-05", "categoria": "Servicios", "descripcion": "Pago luz", "tipo": "egreso", "monto": 120},
+        ]
+    )
+    buffer = BytesIO()
+    df.to_excel(buffer, index=False)
+
+    first = client.post("/api/data/upload", files={"file": ("dedup.xlsx", buffer.getvalue())}, headers=csrf_headers)
+    assert first.status_code == 200
+    assert first.json()["rows_inserted"] == 2
+    assert first.json()["duplicates_skipped"] == 1
+
+    second = client.post("/api/data/upload", files={"file": ("dedup.xlsx", buffer.getvalue())}, headers=csrf_headers)
+    assert second.status_code == 200
+    assert second.json()["rows_inserted"] == 0
+    assert second.json()["duplicates_skipped"] == 3
+
+    records = client.get("/api/data/records")
+    assert len(records.json()) == 2
+
+
+@pytest.mark.parametrize("engine", ["calamine", "openpyxl"])
+def test_workbook_reader_blanks_error_cells_but_keeps_error_like_text(engine, monkeypatch):
+    monkeypatch.setattr(main, "EXCEL_READER_ENGINE", engine)
+    workbook = Workbook()
+    worksheet = workbook.active
+    worksheet.append(["descripcion", "monto"])
+    worksheet.append(["#DIV/0!", "#N/A"])
+    text_cell = worksheet.cell(row=3, column=1, value="#REF!")
+    text_cell.data_type = "s"
+    worksheet.cell(row=3, column=2, value=10.0)
+    buffer = BytesIO()
+    workbook.save(buffer)
+    buffer.seek(0)
+
+    sheet = next(iter_workbook_sheets(buffer, ".xlsx"))
+    assert pd.isna(sheet.iloc[1, 0])
+    assert pd.isna(sheet.iloc[1, 1])
+    assert sheet.iloc[2, 0] == "#REF!"
+    assert sheet.iloc[2, 1] == 10
+
+
+# Expected values are the ones the former per-cell parse_amount produced (NaN where it raised).
+AMOUNT_CASES = [
+    ("1.234,56", 1234.56),
+    ("1,234.56", 1234.56),
+    ("-1.234,56", -1234.56),
+    ("-1,234.56", -1234.56),
+    ("(1.234,56)", 1234.56),
+    ("$ 1.234,56", 1234.56),
+    ("€1,234.56", 1234.56),
+    ("USD 500", 500.0),
+    ("1 234,5", 1234.5),
+    ("12,5", 12.5),
+    ("1,234", 1.234),
+    ("1.234.567", math.nan),
+    ("", math.nan),
+    ("  ", math.nan),
+    ("abc", math.nan),
+    ("-", math.nan),
+    (None, math.nan),
+    (math.nan, math.nan),
+    (1500, 1500.0),
+    (-12.5, -12.5),
+    (0, 0.0),
+]
+
+
+@pytest.mark.parametrize(("raw", "expected"), AMOUNT_CASES)
+def test_parse_amount_series_matches_scalar_parser(raw, expected):
+    parsed = parse_amount_series(pd.Series([raw], dtype=object)).iat[0]
+    if math.isnan(expected):
+        assert math.isnan(parsed)
+    else:
+        assert parsed == pytest.approx(expected)
+
+
+def test_parse_amount_series_handles_mixed_column():
+    raw_values = [raw for raw, _ in AMOUNT_CASES]
+    parsed = parse_amount_series(pd.Series(raw_values, dtype=object)).tolist()
+    expected = [value for _, value in AMOUNT_CASES]
+    assert parsed == pytest.approx(expected, nan_ok=True)
+
+
+DATE_CASES = [
+    ("06/01/2025", date(2025, 1, 6)),
+    ("6/1/2025", date(2025, 1, 6)),
+    ("31/12/2024", date(2024, 12, 31)),
+    ("06-01-2025", date(2025, 1, 6)),
+    ("12/31/2024", date(2024, 12, 31)),
+    ("2025-01-06", date(2025, 1, 6)),
+    # The former per-cell parser dropped this one and read the next as 1 June.
+    ("2025/1/6", date(2025, 1, 6)),
+    ("2025-01-06 10:00:00", date(2025, 1, 6)),
+    (45663, date(2025, 1, 6)),
+    (45663.5, date(2025, 1, 6)),
+    (datetime(2025, 1, 6, 10, 30), date(2025, 1, 6)),
+    (date(2025, 1, 6), date(2025, 1, 6)),
+    (pd.Timestamp("2025-01-06"), date(2025, 1, 6)),
+    (20250106, None),
+    ("6 ene 2025", None),
+    ("abc", None),
+    ("", None),
+    (None, None),
+]
+
+
+@pytest.mark.parametrize(("raw", "expected"), DATE_CASES)
+@pytest.mark.filterwarnings("error::UserWarning")
+def test_parse_date_series_cases(raw, expected):
+    parsed = parse_date_series(pd.Series([raw], dtype=object)).iat[0]
+    assert (None if pd.isna(parsed) else parsed.date()) == expected
+
+
+@pytest.mark.filterwarnings("error::UserWarning")
+def test_parse_date_series_handles_mixed_column():
+    parsed = parse_date_series(pd.Series([raw for raw, _ in DATE_CASES], dtype=object))
+    assert [None if pd.isna(value) else value.date() for value in parsed] == [expected for _, expected in DATE_CASES]